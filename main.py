@@ -1,11 +1,26 @@
-
 #!/usr/bin/env python3
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import hashlib
+import io
 import os
+import signal
+import socket
+import socketserver
 import sys
+import termios
+import threading
+import time
+import tty
 import re
+import select
 import json
+import mmap
+import struct
 
 def hex_to_rgb(hex_color):
     hex_color = hex_color.lstrip('#')
@@ -14,62 +29,162 @@ def hex_to_rgb(hex_color):
 def rgb_to_hex(rgb):
     return f"{rgb[0]:02x}{rgb[1]:02x}{rgb[2]:02x}"
 
-def hex_to_lab(hex_color):
-    r, g, b = [c / 255 for c in hex_to_rgb(hex_color)]
-    r, g, b = [
-        c/12.92 if c <= 0.04045 else ((c+0.055)/1.055)**2.4
-            for c in (r, g, b)
-    ]
-    x, y, z = [
+# Batch color engine. Colors travel as flat N*3 buffers: 8-bit sRGB as
+# bytes, linear RGB / XYZ / LAB as array('d'). The per-color math lives
+# in small functions on three floats; batch conversions loop over them
+# and the one-color helpers call them directly, without any buffers.
+
+SRGB_TO_LINEAR = [
+    c/12.92 if c <= 0.04045 else ((c+0.055)/1.055)**2.4
+    for c in (i / 255 for i in range(256))
+]
+
+def _encode_srgb(c):
+    c = 12.92 * c if c <= 0.0031308 else 1.055 * c**(1/2.4) - 0.055
+    return max(0, min(255, int(c * 255 + 0.5)))
+
+def _linear_to_xyz(r, g, b):
+    return (
         (r*0.4124 + g*0.3576 + b*0.1805) / 0.95047,
         (r*0.2126 + g*0.7152 + b*0.0722) / 1.0,
-        (r*0.0193 + g*0.1192 + b*0.9505) / 1.08883
-    ]
-    fx, fy, fz = [
-        t**(1/3) if t > 0.008856 else 7.787*t + 16/116
-        for t in (x, y, z)
-    ]
+        (r*0.0193 + g*0.1192 + b*0.9505) / 1.08883,
+    )
+
+def _xyz_to_linear(x, y, z):
+    x, y, z = x * 0.95047, y * 1.0, z * 1.08883
+    return (
+        x * 3.2406 + y * -1.5372 + z * -0.4986,
+        x * -0.9689 + y * 1.8758 + z * 0.0415,
+        x * 0.0557 + y * -0.2040 + z * 1.0570,
+    )
+
+def _xyz_to_lab(x, y, z):
+    fx = x**(1/3) if x > 0.008856 else 7.787*x + 16/116
+    fy = y**(1/3) if y > 0.008856 else 7.787*y + 16/116
+    fz = z**(1/3) if z > 0.008856 else 7.787*z + 16/116
     return 116*fy - 16, 500*(fx - fy), 200*(fy - fz)
 
-def lab_to_hex(l, a, b):
+def _lab_to_xyz(l, a, b):
     fy = (l + 16) / 116
     fx = a / 500 + fy
     fz = fy - b / 200
-    x, y, z = [
-        t**3 if t**3 > 0.008856 else (t - 16/116) / 7.787
-        for t in (fx, fy, fz)
-    ]
-    x, y, z = x * 0.95047, y * 1.0, z * 1.08883
-    r = x * 3.2406 + y * -1.5372 + z * -0.4986
-    g = x * -0.9689 + y * 1.8758 + z * 0.0415
-    b_lin = x * 0.0557 + y * -0.2040 + z * 1.0570
-    r, g, b_lin = [
-        12.92 * c if c <= 0.0031308 else 1.055 * c**(1/2.4) - 0.055
-        for c in (r, g, b_lin)
-    ]
-    r = max(0, min(255, int(r * 255 + 0.5)))
-    g = max(0, min(255, int(g * 255 + 0.5)))
-    b_rgb = max(0, min(255, int(b_lin * 255 + 0.5)))
-    return rgb_to_hex((r, g, b_rgb))
+    return (
+        fx**3 if fx**3 > 0.008856 else (fx - 16/116) / 7.787,
+        fy**3 if fy**3 > 0.008856 else (fy - 16/116) / 7.787,
+        fz**3 if fz**3 > 0.008856 else (fz - 16/116) / 7.787,
+    )
+
+def _map_triples(convert, values):
+    out = array('d', values)
+    for i in range(0, len(values), 3):
+        out[i], out[i+1], out[i+2] = convert(values[i], values[i+1], values[i+2])
+    return out
+
+def hex_to_srgb(hex_colors):
+    return bytes.fromhex("".join(c.lstrip('#')[:6] for c in hex_colors))
+
+def srgb_to_hex(srgb):
+    h = bytes(srgb).hex()
+    return [h[i:i+6] for i in range(0, len(h), 6)]
+
+def srgb_to_linear(srgb):
+    return array('d', map(SRGB_TO_LINEAR.__getitem__, srgb))
+
+def linear_to_srgb(linear):
+    return bytes(map(_encode_srgb, linear))
+
+def linear_to_xyz(linear):
+    return _map_triples(_linear_to_xyz, linear)
+
+def xyz_to_linear(xyz):
+    return _map_triples(_xyz_to_linear, xyz)
+
+def xyz_to_lab(xyz):
+    return _map_triples(_xyz_to_lab, xyz)
+
+def lab_to_xyz(lab):
+    return _map_triples(_lab_to_xyz, lab)
+
+def srgb_to_lab(srgb):
+    table = SRGB_TO_LINEAR
+    out = array('d', [0.0]) * len(srgb)
+    for i in range(0, len(srgb), 3):
+        out[i], out[i+1], out[i+2] = _xyz_to_lab(*_linear_to_xyz(
+            table[srgb[i]], table[srgb[i+1]], table[srgb[i+2]]))
+    return out
+
+def lab_to_srgb(lab):
+    out = bytearray(len(lab))
+    for i in range(0, len(lab), 3):
+        r, g, b = _xyz_to_linear(*_lab_to_xyz(lab[i], lab[i+1], lab[i+2]))
+        out[i] = _encode_srgb(r)
+        out[i+1] = _encode_srgb(g)
+        out[i+2] = _encode_srgb(b)
+    return bytes(out)
+
+def hex_to_lab(hex_color):
+    r, g, b = bytes.fromhex(hex_color.lstrip('#')[:6])
+    table = SRGB_TO_LINEAR
+    return _xyz_to_lab(*_linear_to_xyz(table[r], table[g], table[b]))
+
+def lab_to_hex(l, a, b):
+    r, g, b = _xyz_to_linear(*_lab_to_xyz(l, a, b))
+    return "%02x%02x%02x" % (_encode_srgb(r), _encode_srgb(g), _encode_srgb(b))
 
 def lightness_contrast(a, b):
-    l1, _, _ = hex_to_lab(a)
-    l2, _, _ = hex_to_lab(b)
-    return abs(l1 - l2)
+    lab = srgb_to_lab(hex_to_srgb((a, b)))
+    return abs(lab[0] - lab[3])
 
 def adjust_lightness(hex_color, l_delta):
     l, a, b = hex_to_lab(hex_color)
     new_l = max(0, min(100, l + l_delta))
     return lab_to_hex(new_l, a, b)
 
+LIGHTNESS_SOLVER_MAX_ITERATIONS = 16
+
+def solve_lightness(hex_color, min_contrast, direction=1, first=1, last=100):
+    # Smallest offset k in [first, last] such that shifting hex_color's LAB
+    # lightness by direction * k gives a contrast above min_contrast.
+    # Falls back to last when the contrast is out of reach. Probes stay in
+    # LAB/sRGB buffers; contrast is measured on the rounded 8-bit color.
+    lab = srgb_to_lab(hex_to_srgb((hex_color,)))
+    l, a, b = lab
+
+    def probe(k):
+        new_l = max(0, min(100, l + direction * k))
+        srgb = lab_to_srgb(array('d', (new_l, a, b)))
+        return srgb, abs(l - srgb_to_lab(srgb)[0]) > min_contrast
+
+    srgb, reached = probe(last)
+    if not reached:
+        return srgb.hex()
+    lo, hi = first, last
+    for _ in range(LIGHTNESS_SOLVER_MAX_ITERATIONS):
+        if lo >= hi:
+            break
+        mid = (lo + hi) // 2
+        mid_srgb, reached = probe(mid)
+        if reached:
+            hi, srgb = mid, mid_srgb
+        else:
+            lo = mid + 1
+    return srgb.hex()
+
 def is_light_theme(bg_hex, fg_hex):
-    bg_l, _, _ = hex_to_lab(bg_hex)
-    fg_l, _, _ = hex_to_lab(fg_hex)
-    return bg_l > fg_l
+    lab = srgb_to_lab(hex_to_srgb((bg_hex, fg_hex)))
+    return lab[0] > lab[3]
 
 class Style:
-    def __init__(
-        self,
+    # Immutable and interned: equal arguments give the same object, whose
+    # SGR prefix is computed once.
+    FIELDS = (
+        "bold", "italic", "underline", "dim", "blink",
+        "reverse", "hidden", "strikethrough", "fg", "bg",
+    )
+    __slots__ = FIELDS + ("prefix",)
+
+    def __new__(
+        cls,
         bold=False,
         italic=False,
         underline=False,
@@ -81,32 +196,35 @@ class Style:
         fg=None,
         bg=None,
     ):
-        self.bold = bold
-        self.italic = italic
-        self.underline = underline
-        self.dim = dim
-        self.blink = blink
-        self.reverse = reverse
-        self.hidden = hidden
-        self.strikethrough = strikethrough
-        self.fg = fg
-        self.bg = bg
+        return cls._intern(bold, italic, underline, dim, blink,
+            reverse, hidden, strikethrough, fg, bg)
+
+    @classmethod
+    @lru_cache(maxsize=4096)
+    def _intern(cls, *values):
+        self = object.__new__(cls)
+        for name, value in zip(cls.FIELDS, values):
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, "prefix", self._sgr_prefix())
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Style is immutable, use replace()")
+
+    def __repr__(self):
+        return "Style(%s)" % ", ".join(
+            "%s=%r" % (name, getattr(self, name)) for name in self.FIELDS
+            if getattr(self, name) not in (False, None))
+
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self.FIELDS}
+        values.update(changes)
+        return Style(**values)
 
     def clone(self):
-        return Style(
-            bold = self.bold,
-            italic = self.italic,
-            underline = self.underline,
-            dim = self.dim,
-            blink = self.blink,
-            reverse = self.reverse,
-            hidden = self.hidden,
-            strikethrough = self.strikethrough,
-            fg = self.fg,
-            bg = self.bg,
-        )
-    
-    def apply(self, text):
+        return self
+
+    def _sgr_prefix(self):
         codes = []
         
         if self.bold: codes.append('1')
@@ -135,11 +253,25 @@ class Style:
                     codes.append(f'{38 + offset};5;{color}')
 
         if not codes:
+            return ""
+
+        return f"\033[{';'.join(codes)}m"
+
+    def apply(self, text):
+        if not self.prefix:
             return text
+        return f"{self.prefix}{text}\033[0m"
 
-        return f"\033[{';'.join(codes)}m{text}\033[0m"
+    def apply_many(self, texts):
+        if not self.prefix:
+            return list(texts)
+        prefix = self.prefix
+        return [f"{prefix}{text}\033[0m" for text in texts]
 
 class Block:
+    # A block is a vertical run of items: (content, width) lines and
+    # Columns laid side by side. Nesting only shares references; text is
+    # padded and joined once, when the whole frame is rendered.
     @staticmethod
     def vertical(*args, gap=0):
         return Block(*args, axis=1, gap=gap)
@@ -149,45 +281,77 @@ class Block:
         return Block(*args, axis=0, gap=gap)
 
     def __init__(self, *args, width=None, axis=1, gap=0):
-        self.lines = []
+        self.items = []
+        self._rows = None
         blocks = Block._normalize_args(*args)
         if axis == 0:
-            max_lines = max((len(block.lines) for block in blocks), default=0)
-            col_widths = []
-            for block in blocks:
-                max_width = max((width for _, width in block.lines), default=0)
-                col_widths.append(max_width)
-            for line_idx in range(max_lines):
-                line_parts = []
-                for col_idx, block in enumerate(blocks):
-                    if line_idx < len(block.lines):
-                        content, width = block.lines[line_idx]
-                        padding_needed = col_widths[col_idx] - width
-                        line_parts.append(content + " " * padding_needed)
-                    else:
-                        line_parts.append(" " * col_widths[col_idx])
-                separator = " " * gap
-                combined_line = separator.join(line_parts)
-                total_width = sum(col_widths) + gap * (len(blocks) - 1)
-                self.lines.append((combined_line, total_width))
+            blocks = [Block._snapshot(block) for block in blocks]
+            if any(block.height for block in blocks):
+                self.items.append(Columns(blocks, gap))
         else:
             for i, block in enumerate(blocks):
-                self.lines.extend(block.lines)
+                self.items.extend(block.items)
                 if i < len(blocks) - 1:
                     for _ in range(gap):
-                        self.lines.append(("", 0))
+                        self.items.append(("", 0))
         if width is not None:
-            for i, line in enumerate(self.lines):
-                self.lines[i] = (line[0], width)
-    
+            self.items = [
+                (item[0], width) if isinstance(item, tuple) else item.with_width(width)
+                for item in self.items
+            ]
+
+    @staticmethod
+    def _snapshot(block):
+        copy = Block()
+        copy.items = list(block.items)
+        return copy
+
+    @property
+    def height(self):
+        return len(self._row_index())
+
+    @property
+    def width(self):
+        return max((item[1] if isinstance(item, tuple) else item.width
+            for item in self.items), default=0)
+
+    @property
+    def lines(self):
+        lines = []
+        for row in range(self.height):
+            out = []
+            width = self._row(row, out)
+            lines.append(("".join(out), width))
+        return lines
+
+    def _row_index(self):
+        if self._rows is None:
+            self._rows = []
+            for item in self.items:
+                if isinstance(item, tuple):
+                    self._rows.append((item, 0))
+                else:
+                    self._rows.extend((item, row) for row in range(item.height))
+        return self._rows
+
+    def _row(self, row, out):
+        # Appends the pieces of one row to out; returns its declared width.
+        item, local_row = self._row_index()[row]
+        if isinstance(item, tuple):
+            out.append(item[0])
+            return item[1]
+        return item.row(local_row, out)
+
     def append(self, content, width=None):
         if width is None:
             width = len(content)
-        self.lines.append((content, width))
+        self.items.append((content, width))
+        self._rows = None
         return self
     
     def extend(self, block):
-        self.lines.extend(block.lines)
+        self.items.extend(block.items)
+        self._rows = None
         return self
     
     @staticmethod
@@ -210,121 +374,478 @@ class Block:
             else:
                 child = Block()
                 s = str(arg)
-                child.lines.append((s, len(s)))
+                child.items.append((s, len(s)))
                 blocks.append(child)
         return blocks
+
+    def render(self):
+        out = []
+        for row in range(self.height):
+            self._row(row, out)
+            out.append("\n")
+        return "".join(out)
     
     def print(self):
-        for content, _ in self.lines:
-            print(content)
-
-def generate_palette(theme):
-    def blend_palette_colors(rgb, theme):
-        def lerp(t, c1, c2):
-            return tuple((1-t)*c1[i] + t*c2[i] for i in range(3))
-        final = lerp(rgb[2],
-            lerp(rgb[1],
-                lerp(rgb[0], hex_to_rgb(theme.bg), hex_to_rgb(theme[1])),
-                lerp(rgb[0], hex_to_rgb(theme[2]), hex_to_rgb(theme[3]))
-            ),
-            lerp(rgb[1],
-                lerp(rgb[0], hex_to_rgb(theme[4]), hex_to_rgb(theme[5])),
-                lerp(rgb[0], hex_to_rgb(theme[6]), hex_to_rgb(theme.fg))
-            )
-        )
-        return rgb_to_hex([int(round(c)) for c in final])
-
-    def generate_rgb_cube(theme, dark_adjust=0.0):
-        colors = []
-        for r in range(6):
-            for g in range(6):
-                for b in range(6):
-                    normalised = (r / 5, g / 5, b / 5)
-                    dark_adjustment = \
-                        (max(normalised) * (sum(normalised) / len(normalised))) ** dark_adjust;
-                    colors.append(blend_palette_colors(
-                        tuple(n * dark_adjustment for n in normalised),
-                        theme
-                    ))
-        return colors
+        data = self.render().encode()
+        sys.stdout.flush()
+        sys.stdout.buffer.write(data)
+        sys.stdout.flush()
+
+class Columns:
+    # Blocks side by side, each padded to its widest line.
+    __slots__ = ("blocks", "gap", "widths", "height", "width")
+
+    def __init__(self, blocks, gap=0, width=None):
+        self.blocks = blocks
+        self.gap = gap
+        self.widths = [block.width for block in blocks]
+        self.height = max((block.height for block in blocks), default=0)
+        if width is None:
+            width = sum(self.widths) + gap * (len(blocks) - 1)
+        self.width = width
+
+    def with_width(self, width):
+        return Columns(self.blocks, self.gap, width)
+
+    def row(self, row, out):
+        separator = " " * self.gap
+        for i, (block, width) in enumerate(zip(self.blocks, self.widths)):
+            if i and separator:
+                out.append(separator)
+            if row < block.height:
+                width -= block._row(row, out)
+            if width > 0:
+                out.append(" " * width)
+        return self.width
+
+def trilinear_weights(r, g, b, dark_adjust=0.0):
+    # Weights of the eight cube corners (bg, 1..6, fg; bit 0 = red,
+    # bit 1 = green, bit 2 = blue) for cube cell (r, g, b).
+    normalised = (r / 5, g / 5, b / 5)
+    dark_adjustment = \
+        (max(normalised) * (sum(normalised) / len(normalised))) ** dark_adjust
+    tr, tg, tb = (n * dark_adjustment for n in normalised)
+    return tuple(
+        (tr if k & 1 else 1 - tr) * (tg if k & 2 else 1 - tg) * (tb if k & 4 else 1 - tb)
+        for k in range(8)
+    )
+
+@lru_cache(maxsize=256)
+def cube_weights(dark_adjust=0.0):
+    return tuple(
+        trilinear_weights(r, g, b, dark_adjust)
+        for r in range(6)
+        for g in range(6)
+        for b in range(6)
+    )
+
+@lru_cache(maxsize=256)
+def grayscale_weights(dark_adjust=0.0):
+    weights = []
+    for i in range(24):
+        t = (i + 1) / 25
+        t = t * (t ** dark_adjust)
+        weights.append((1 - t, t))
+    return tuple(weights)
+
+def blend_colors(weights, srgb):
+    # Matrix product of an N*K weight table with K packed sRGB colors.
+    out = array('d', bytes(8 * 3 * len(weights)))
+    for row, row_weights in enumerate(weights):
+        r = g = b = 0.0
+        for k, w in enumerate(row_weights):
+            r += w * srgb[3*k]
+            g += w * srgb[3*k + 1]
+            b += w * srgb[3*k + 2]
+        out[3*row:3*row + 3] = array('d', (r, g, b))
+    return out
+
+def parse_precision(value):
+    try:
+        precision = float(value)
+    except ValueError:
+        raise ArgumentTypeError("invalid precision %r" % value)
+    if not precision > 0:
+        raise ArgumentTypeError("precision must be positive, got %r" % value)
+    return precision
+
+def generate_palette(theme, search="bisect", precision=0.01):
+    def generate_rgb_cube(corners, dark_adjust=0.0):
+        blended = blend_colors(cube_weights(dark_adjust), corners)
+        return bytes(int(round(c)) for c in blended)
 
     def generate_grayscale(theme, dark_adjust=0.0):
-        colors = []
-        bg = hex_to_rgb(theme.bg)
-        fg = hex_to_rgb(theme.fg)
-        for i in range(24):
-            t = (i + 1) / 25
-            t = t * (t ** dark_adjust)
-            rgb = tuple(int((1 - t) * bg[i] + t * fg[i]) for i in range(3))
-            colors.append(rgb_to_hex(rgb))
-        return colors
+        blended = blend_colors(
+            grayscale_weights(dark_adjust),
+            hex_to_srgb((theme.bg, theme.fg))
+        )
+        return bytes(int(c) for c in blended)
 
     def find_good_contrast_palette(theme):
+        # The palette settles on the first dark_adjust step at which one of
+        # the darkest red/green/blue cube entries drops to a lightness
+        # contrast of 5 or less against the background, or on the last
+        # step below 0.5. Only those three probe colors are evaluated while
+        # searching; the full palette is built once at the end.
+        if precision <= 0:
+            raise ValueError("contrast precision must be positive")
+        steps = [0]
         dark_adjust = 0
-        palette = [
-            *theme[:16],
-            *generate_rgb_cube(theme, dark_adjust),
-            *generate_grayscale(theme, dark_adjust)
-        ]
-        next_palette = palette
-        while all(lightness_contrast(theme.bg, palette[16 + i]) > 5
-            for i in (36,6,1)
-        ):
-            palette = next_palette
-            dark_adjust += 0.01
+        while True:
+            dark_adjust += precision
             if dark_adjust >= 0.5:
                 break
-            next_palette = [
-                *theme[:16],
-                *generate_rgb_cube(theme, dark_adjust),
-                *generate_grayscale(theme, dark_adjust)
+            steps.append(dark_adjust)
+
+        corners = hex_to_srgb((theme.bg, *theme[1:7], theme.fg))
+        bg_l = hex_to_lab(theme.bg)[0]
+        def has_contrast(step):
+            weights = [
+                trilinear_weights(r, g, b, steps[step])
+                for r, g, b in ((1, 0, 0), (0, 1, 0), (0, 0, 1))
             ]
+            blended = blend_colors(weights, corners)
+            lab = srgb_to_lab(bytes(int(round(c)) for c in blended))
+            return all(abs(bg_l - lab[i]) > 5 for i in range(0, 9, 3))
+
+        last = len(steps) - 1
+        if search == "linear":
+            step = 0
+            while step < last and has_contrast(step):
+                step += 1
+        elif search == "bisect":
+            if has_contrast(last):
+                step = last
+            else:
+                lo, hi = 0, last
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if has_contrast(mid):
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                step = lo
+        else:
+            raise ValueError("unknown contrast search %r" % search)
 
-        return palette
+        return b"".join((
+            theme.buffer()[:16 * 3],
+            generate_rgb_cube(corners, steps[step]),
+            generate_grayscale(theme, steps[step])
+        ))
 
     light = is_light_theme(theme.bg, theme.fg)
 
     for i in range(8):
         if theme[i + 8] == theme[i]:
-            j = 1
-            l_delta = (-1 if light else 1) if i in (0, 7) else 1
-            while True:
-                theme[i + 8] = adjust_lightness(theme[i], j)
-                if lightness_contrast(theme[i], theme[i + 8]) > 4:
-                    break;
-                j += l_delta
+            if light and i in (0, 7):
+                # Black/white on light themes try one unit lighter first,
+                # then search darker.
+                bright = adjust_lightness(theme[i], 1)
+                if lightness_contrast(theme[i], bright) <= 4:
+                    bright = solve_lightness(theme[i], 4, direction=-1)
+            else:
+                bright = solve_lightness(theme[i], 4)
+            theme[i + 8] = bright
 
     if theme[0] == theme.bg:
-        i = 1
-        while i < 100:
-            theme[0] = adjust_lightness(theme.bg, -i)
-            if lightness_contrast(theme.bg, theme[0]) > 4:
-                break;
-            i += 1
+        theme[0] = solve_lightness(theme.bg, 4, direction=-1, last=99)
 
-    i = 1
-    l_delta = (-1 if light else 1)
-    while i < 100:
-        theme[8] = adjust_lightness(theme.bg, i * l_delta)
-        if lightness_contrast(theme.bg, theme[8]) > 20:
-            break;
-        i += 1
+    theme[8] = solve_lightness(theme.bg, 20, direction=-1 if light else 1, last=99)
 
     theme.palette = find_good_contrast_palette(theme)
 
 
+# Bump whenever generate_palette can produce different output for the
+# same input, so stale cache entries are never reused.
+PALETTE_ALGORITHM_VERSION = 1
+PALETTE_CACHE_MAX_BYTES = 4 * 1024 * 1024
+
+def palette_cache_key(theme, search="bisect", precision=0.01):
+    h = hashlib.sha256()
+    h.update(b"%d %s %r\n" % (PALETTE_ALGORITHM_VERSION, search.encode(), precision))
+    h.update(theme.buffer()[:16 * 3])
+    h.update(theme.buffer()[-6:])
+    return h.hexdigest()
+
+class PaletteCache:
+    # Finished 256-color palettes stored as raw RGB bytes, one file per
+    # key, plus nearest-color grids for them. File mtimes track recency
+    # for LRU eviction.
+    SUFFIXES = (".rgb", ".nn")
+
+    def __init__(self, directory, max_bytes=PALETTE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key, suffix=".rgb"):
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key, suffix=".rgb", size=256 * 3):
+        path = self._path(key, suffix)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        if len(data) != size:
+            return None
+        return data
+
+    def put(self, key, data, suffix=".rgb"):
+        path = self._path(key, suffix)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self.evict()
+        except OSError:
+            pass
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(PaletteCache.SUFFIXES):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+def generate_palette_cached(theme, cache=None, search="bisect", precision=0.01):
+    if cache is None:
+        generate_palette(theme, search=search, precision=precision)
+        return
+    key = palette_cache_key(theme, search, precision)
+    data = cache.get(key)
+    if data is None:
+        generate_palette(theme, search=search, precision=precision)
+        cache.put(key, bytes(theme.buffer()[:-6]))
+    else:
+        theme.palette = data
+
+NEAREST_GRID_BITS = 5
+NEAREST_GRID_SHIFT = 8 - NEAREST_GRID_BITS
+NEAREST_GRID_CELLS = 1 << 3 * NEAREST_GRID_BITS
+NEAREST_BLOCK_BITS = 2
+NEAREST_GRID_VERSION = 1
+
+class NearestGrid:
+    # Maps 8-bit RGB to the palette index closest in LAB. The RGB cube is
+    # split into 32^3 cells, each holding the index nearest to the cell
+    # center, so a lookup is one table read. Cells are resolved in blocks
+    # of 4^3 on first use, sharing one distance-ordered scan of the
+    # palette per block.
+    def __init__(self, srgb, table=None):
+        lab = srgb_to_lab(srgb)
+        self.points = [tuple(lab[i:i+3]) for i in range(0, len(lab), 3)]
+        if table is None:
+            self.table = bytearray(NEAREST_GRID_CELLS)
+            self.known = bytearray(NEAREST_GRID_CELLS >> 3 * NEAREST_BLOCK_BITS)
+        else:
+            self.table = bytearray(table)
+            self.known = None
+
+    @staticmethod
+    def _cell(r, g, b):
+        return r << 2 * NEAREST_GRID_BITS | g << NEAREST_GRID_BITS | b
+
+    @staticmethod
+    def _block(cell):
+        bits = NEAREST_GRID_BITS - NEAREST_BLOCK_BITS
+        mask = (1 << bits) - 1
+        return (
+            cell >> 2 * NEAREST_GRID_BITS + NEAREST_BLOCK_BITS << 2 * bits
+            | (cell >> NEAREST_GRID_BITS + NEAREST_BLOCK_BITS & mask) << bits
+            | cell >> NEAREST_BLOCK_BITS & mask
+        )
+
+    def _resolve(self, block):
+        bits = NEAREST_GRID_BITS - NEAREST_BLOCK_BITS
+        mask = (1 << bits) - 1
+        size = 1 << NEAREST_BLOCK_BITS
+        r0 = (block >> 2 * bits) * size
+        g0 = (block >> bits & mask) * size
+        b0 = (block & mask) * size
+        half = 1 << NEAREST_GRID_SHIFT - 1
+        cells = []
+        srgb = bytearray()
+        for r in range(r0, r0 + size):
+            for g in range(g0, g0 + size):
+                for b in range(b0, b0 + size):
+                    cells.append(NearestGrid._cell(r, g, b))
+                    srgb += bytes((
+                        (r << NEAREST_GRID_SHIFT) + half,
+                        (g << NEAREST_GRID_SHIFT) + half,
+                        (b << NEAREST_GRID_SHIFT) + half,
+                    ))
+        lab = srgb_to_lab(srgb)
+        centers = [lab[i:i+3] for i in range(0, len(lab), 3)]
+
+        # Entries are tried in order of distance from the block's mean m.
+        # By the triangle inequality d(c, p) >= d(m, p) - d(m, c), so a
+        # cell's scan stops once that bound exceeds its best distance.
+        mean = [sum(c[k] for c in centers) / len(centers) for k in range(3)]
+        ordered = sorted(
+            (((p[0] - mean[0])**2 + (p[1] - mean[1])**2 + (p[2] - mean[2])**2)**0.5, i, p)
+            for i, p in enumerate(self.points)
+        )
+        for cell, (l, a, b) in zip(cells, centers):
+            offset = ((l - mean[0])**2 + (a - mean[1])**2 + (b - mean[2])**2)**0.5
+            best, best_d = 0, float("inf")
+            for bound, i, p in ordered:
+                if bound - offset > best_d:
+                    break
+                d = ((p[0] - l)**2 + (p[1] - a)**2 + (p[2] - b)**2)**0.5
+                # Ties go to the lower index.
+                if d < best_d or (d == best_d and i < best):
+                    best, best_d = i, d
+            self.table[cell] = best
+        self.known[block] = 1
+
+    def lookup(self, r, g, b):
+        cell = NearestGrid._cell(
+            r >> NEAREST_GRID_SHIFT,
+            g >> NEAREST_GRID_SHIFT,
+            b >> NEAREST_GRID_SHIFT,
+        )
+        if self.known is not None:
+            block = NearestGrid._block(cell)
+            if not self.known[block]:
+                self._resolve(block)
+        return self.table[cell]
+
+    def lookup_many(self, srgb):
+        lookup = self.lookup
+        return bytes(lookup(*srgb[i:i+3]) for i in range(0, len(srgb), 3))
+
+    def complete(self):
+        # Resolves every cell and returns the finished table, the form
+        # stored in PaletteCache.
+        if self.known is not None:
+            for block in range(len(self.known)):
+                if not self.known[block]:
+                    self._resolve(block)
+            self.known = None
+        return bytes(self.table)
+
+def nearest_grid_key(srgb):
+    h = hashlib.sha256()
+    h.update(b"nearest %d %d\n" % (NEAREST_GRID_VERSION, NEAREST_GRID_BITS))
+    h.update(srgb)
+    return h.hexdigest()
+
 class Theme:
+    # Colors are packed into one bytearray: the palette as 3-byte RGB
+    # entries followed by bg and fg. Hex strings are produced on access.
+    __slots__ = ("name", "_colors", "_nearest")
+
     def __init__(self, name, palette, bg=None, fg=None):
         self.name = name
-        self.palette = palette
-        self.bg = bg or palette[0]
-        self.fg = fg or palette[7]
+        self._nearest = None
+        colors = Theme._pack(palette)
+        self._colors = bytearray(colors)
+        self._colors += Theme._pack_color(bg) if bg else colors[0:3]
+        self._colors += Theme._pack_color(fg) if fg else colors[21:24]
+
+    @staticmethod
+    def _pack(colors):
+        if isinstance(colors, (bytes, bytearray, memoryview)):
+            return bytes(colors)
+        return hex_to_srgb(colors)
+
+    @staticmethod
+    def _pack_color(color):
+        if isinstance(color, (bytes, bytearray, memoryview)):
+            return bytes(color)
+        return hex_to_srgb((color,))
+
+    def __len__(self):
+        return len(self._colors) // 3 - 2
+
+    def _offset(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("theme color index out of range")
+        return 3 * index
 
     def __setitem__(self, index, value):
-        self.palette.__setitem__(index, value)
+        if isinstance(index, slice):
+            for i, v in zip(range(*index.indices(len(self))), value):
+                self[i] = v
+            return
+        offset = self._offset(index)
+        self._colors[offset:offset + 3] = Theme._pack_color(value)
+        self._nearest = None
 
     def __getitem__(self, index):
-        return self.palette.__getitem__(index)
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        offset = self._offset(index)
+        return self._colors[offset:offset + 3].hex()
+
+    @property
+    def palette(self):
+        return srgb_to_hex(self._colors[:-6])
+
+    @palette.setter
+    def palette(self, palette):
+        self._colors = bytearray(Theme._pack(palette)) + self._colors[-6:]
+        self._nearest = None
+
+    @property
+    def bg(self):
+        return self._colors[-6:-3].hex()
+
+    @bg.setter
+    def bg(self, value):
+        self._colors[-6:-3] = Theme._pack_color(value)
+
+    @property
+    def fg(self):
+        return self._colors[-3:].hex()
+
+    @fg.setter
+    def fg(self, value):
+        self._colors[-3:] = Theme._pack_color(value)
+
+    def buffer(self):
+        # Read-only view of the packed RGB bytes: len(self) palette
+        # entries followed by bg and fg.
+        return memoryview(self._colors).toreadonly()
+
+    def nearest_grid(self, cache=None):
+        # Built once per palette. With a cache the grid is completed up
+        # front so it can be stored and shared between runs.
+        if self._nearest is None:
+            srgb = bytes(self._colors[:-6])
+            if cache is None:
+                self._nearest = NearestGrid(srgb)
+            else:
+                key = nearest_grid_key(srgb)
+                table = cache.get(key, ".nn", NEAREST_GRID_CELLS)
+                self._nearest = NearestGrid(srgb, table)
+                if table is None:
+                    cache.put(key, self._nearest.complete(), ".nn")
+        return self._nearest
+
+    def nearest(self, rgb):
+        # Palette index closest to an (r, g, b) color.
+        return self.nearest_grid().lookup(*rgb)
+
+    def nearest_many(self, srgb):
+        # Palette indices for a flat N*3 sRGB buffer, as bytes.
+        return self.nearest_grid().lookup_many(srgb)
 
     def greyscale(self, index):
         return self[232 + index]
@@ -336,11 +857,48 @@ class Theme:
     def selection(self):
         return self.greyscale(5)
 
+# A theme line is classified with one match from the line start: after
+# the first alphanumeric run and the separator following it, either the
+# last hex color ("key ... rrggbb") or else the first integer
+# ("key ... 7"); failing both, the first hex color anywhere on the line.
+THEME_LINE_RE = re.compile(r"""
+    (?:
+        [^a-z0-9]*
+        (?P<key>[a-z0-9]+[^a-z0-9])
+        (?:
+            (?=.*(?P<hex_value>[a-f0-9]{6}))
+        |
+            (?=.*?(?P<int_value>[0-9]+))
+        )
+    |
+        (?=.*?(?P<hex>[a-f0-9]{6}))
+    )?
+""", re.VERBOSE)
+THEME_INT_RE = re.compile(r"([0-9]+)")
+
+def _json_theme_lines(value, prefix=""):
+    # Yields the lines json.dumps(value, indent=4) would produce, minus
+    # indentation and separators, without building the document.
+    if isinstance(value, dict):
+        if not value:
+            yield prefix + "{}"
+            return
+        yield prefix + "{"
+        for key, item in value.items():
+            yield from _json_theme_lines(item, json.dumps(key).lower() + ": ")
+        yield "}"
+    elif isinstance(value, list):
+        if not value:
+            yield prefix + "[]"
+            return
+        yield prefix + "["
+        for item in value:
+            yield from _json_theme_lines(item)
+        yield "]"
+    else:
+        yield prefix + json.dumps(value).lower()
+
 def parse_theme(fname):
-    hex_key_re = re.compile(r"([a-z0-9]+[^a-z0-9].*)([a-f0-9]{6})")
-    int_key_re = re.compile(r"([a-z0-9]+[^a-z0-9].*?)([0-9]+)")
-    int_re = re.compile(r"([0-9]+)")
-    hex_re = re.compile(r"#?([a-f0-9]{6})")
     palette_group = None
     color_names = [
         "black",
@@ -360,17 +918,16 @@ def parse_theme(fname):
 
     with open(fname) as f:
         content = f.read()
-        try:
-            content = json.dumps(json.loads(content), indent=4)
-        except:
-            pass
-
-    for line in content.splitlines():
-        line = line.strip().lower()
-        match = hex_key_re.search(line)
-        if match:
-            key = match.group(1).lower()
-            color = match.group(2)
+    try:
+        lines = _json_theme_lines(json.loads(content))
+    except ValueError:
+        lines = content.lower().splitlines()
+
+    for line in lines:
+        match = THEME_LINE_RE.match(line)
+        if match.group("hex_value") is not None:
+            key = line[match.start("key"):match.start("hex_value")]
+            color = match.group("hex_value")
             if "cursor" in key or "selection" in key:
                 pass
             elif "foreground" in key or "fg" in key:
@@ -387,7 +944,7 @@ def parse_theme(fname):
                             palette[idx] = color
                         break
                 else:
-                    match = int_re.search(key)
+                    match = THEME_INT_RE.search(key)
                     if match:
                         idx = int(match.group(1))
                         if "bright" in key or palette_group == "bright":
@@ -397,10 +954,9 @@ def parse_theme(fname):
                                 palette[idx] = color
             continue
 
-        match = int_key_re.search(line)
-        if match:
-            key = match.group(1).lower()
-            idx = int(match.group(2))
+        if match.group("int_value") is not None:
+            key = line[match.start("key"):match.start("int_value")]
+            idx = int(match.group("int_value"))
             if idx < len(palette):
                 if "cursor" in key or "selection" in key:
                     pass
@@ -410,12 +966,11 @@ def parse_theme(fname):
                     bg = palette[idx]
             continue
 
-        match = hex_re.search(line)
-        if match:
+        if match.group("hex") is not None:
             if idx < len(palette):
-                palette[idx] = match.group(1)
+                palette[idx] = match.group("hex")
             elif idx == len(palette):
-                palette.append(match.group(1))
+                palette.append(match.group("hex"))
             idx += 1
             continue
 
@@ -442,129 +997,643 @@ def parse_theme(fname):
     )
     return instance
 
-def apply_color(type_index, palette_index, color):
+def adjust_theme_lightness(theme, l_delta):
+    theme.fg = adjust_lightness(theme.fg, l_delta)
+    theme.bg = adjust_lightness(theme.bg, l_delta)
+    for i in range(min(16, len(theme))):
+        theme[i] = adjust_lightness(theme[i], l_delta)
+
+def load_theme(fname, adjust=None, cache=None, search="bisect", precision=0.01):
+    theme = parse_theme(fname)
+    if adjust is not None:
+        adjust_theme_lightness(theme, adjust)
+    generate_palette_cached(theme, cache, search=search, precision=precision)
+    return theme
+
+# Theme library index: one file holding a header, fixed-size records
+# and an open-addressing name table, read through mmap so looking a theme
+# up by name neither parses nor generates anything.
+#
+#   header  magic, PALETTE_ALGORITHM_VERSION, record count, table slots,
+#           contrast precision, contrast search
+#   record  name, source path (relative to the index), source mtime_ns,
+#           source size, source sha256, 16-color input + bg + fg,
+#           generated 256-color palette + bg + fg
+#   table   uint32 slots holding record number + 1 (0 = empty), probed
+#           linearly from the name hash
+THEME_INDEX_MAGIC = b"C256IDX1"
+THEME_INDEX_NAME = ".color256.idx"
+THEME_INDEX_HEADER = struct.Struct("<8sIIId8s")
+THEME_INDEX_RECORD = struct.Struct("<128s128sqq32s54s774s")
+THEME_INDEX_SLOT = struct.Struct("<I")
+
+def _index_name_hash(name):
+    return int.from_bytes(hashlib.sha1(name.encode()).digest()[:4], "little")
+
+def _file_sha256(fname):
+    with open(fname, "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+class ThemeIndex:
+    def __init__(self, path):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        with open(path, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError("%s is not a theme index" % path)
+        if len(self._map) < THEME_INDEX_HEADER.size:
+            self.close()
+            raise ValueError("%s is not a theme index" % path)
+        magic, version, self.count, self.slots, self.precision, search = \
+            THEME_INDEX_HEADER.unpack_from(self._map)
+        if magic != THEME_INDEX_MAGIC:
+            self.close()
+            raise ValueError("%s is not a theme index" % path)
+        self.version = version
+        self.search = search.rstrip(b"\0").decode()
+        self._table = THEME_INDEX_HEADER.size + self.count * THEME_INDEX_RECORD.size
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def record(self, i):
+        name, source, mtime, size, digest, colors, palette = THEME_INDEX_RECORD.unpack_from(
+            self._map, THEME_INDEX_HEADER.size + i * THEME_INDEX_RECORD.size)
+        return {
+            "name": name.rstrip(b"\0").decode(),
+            "source": source.rstrip(b"\0").decode(),
+            "mtime": mtime,
+            "size": size,
+            "sha256": digest,
+            "colors": colors,
+            "palette": palette,
+        }
+
+    def records(self):
+        return (self.record(i) for i in range(self.count))
+
+    def find(self, name):
+        if not self.slots:
+            return None
+        encoded = name.encode()
+        slot = _index_name_hash(name) % self.slots
+        while True:
+            (entry,) = THEME_INDEX_SLOT.unpack_from(
+                self._map, self._table + slot * THEME_INDEX_SLOT.size)
+            if entry == 0:
+                return None
+            offset = THEME_INDEX_HEADER.size + (entry - 1) * THEME_INDEX_RECORD.size
+            if self._map[offset:offset + 128].rstrip(b"\0") == encoded:
+                return self.record(entry - 1)
+            slot = (slot + 1) % self.slots
+
+    def load(self, name, adjust=None, cache=None, search="bisect", precision=0.01):
+        record = self.find(name)
+        if record is None:
+            return None
+        source = os.path.join(self.directory, record["source"])
+        signature = file_signature(source)
+        if signature is not None and signature != (record["mtime"], record["size"]):
+            if _file_sha256(source) != record["sha256"]:
+                return load_theme(source, adjust, cache, search=search, precision=precision)
+        colors = record["colors"]
+        current = (
+            self.version == PALETTE_ALGORITHM_VERSION
+            and self.search == search
+            and self.precision == precision
+        )
+        if adjust is None and current:
+            palette = record["palette"]
+            return Theme(name, palette[:-6], bg=palette[-6:-3], fg=palette[-3:])
+        theme = Theme(name, colors[:-6], bg=colors[-6:-3], fg=colors[-3:])
+        if adjust is not None:
+            adjust_theme_lightness(theme, adjust)
+        generate_palette_cached(theme, cache, search=search, precision=precision)
+        return theme
+
+def build_theme_index(directory, path=None, search="bisect", precision=0.01):
+    # Returns (themes indexed, themes parsed and generated). Records whose
+    # source is unchanged (same mtime and size, or same sha256) are copied
+    # from the existing index.
+    path = path or os.path.join(directory, THEME_INDEX_NAME)
+    index_dir = os.path.dirname(os.path.abspath(path))
+    previous = {}
+    try:
+        with ThemeIndex(path) as index:
+            if (index.version, index.search, index.precision) == \
+                    (PALETTE_ALGORITHM_VERSION, search, precision):
+                previous = {r["source"]: r for r in index.records()}
+    except (OSError, ValueError, struct.error):
+        pass
+
+    records = {}
+    rebuilt = 0
+    for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+        if entry.name.startswith(".") or not entry.is_file():
+            continue
+        source = os.path.relpath(entry.path, index_dir)
+        stat = entry.stat()
+        record = previous.get(source)
+        if record is not None and (record["mtime"], record["size"]) != \
+                (stat.st_mtime_ns, stat.st_size):
+            if record["size"] != stat.st_size or _file_sha256(entry.path) != record["sha256"]:
+                record = None
+            else:
+                record = dict(record, mtime=stat.st_mtime_ns)
+        if record is None:
+            try:
+                theme = parse_theme(entry.path)
+            except Exception as e:
+                print("skipping %s: %s" % (entry.path, e), file=sys.stderr)
+                continue
+            colors = bytes(theme.buffer()[:16 * 3]) + bytes(theme.buffer()[-6:])
+            generate_palette(theme, search=search, precision=precision)
+            record = {
+                "name": theme.name,
+                "source": source,
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "sha256": _file_sha256(entry.path),
+                "colors": colors,
+                "palette": bytes(theme.buffer()),
+            }
+            rebuilt += 1
+        if len(record["name"].encode()) > 128 or len(source.encode()) > 128:
+            print("skipping %s: name too long for the index" % entry.path, file=sys.stderr)
+            continue
+        if len(record["palette"]) != 774:
+            print("skipping %s: palette is not 256 colors" % entry.path, file=sys.stderr)
+            continue
+        if record["name"] in records:
+            print("duplicate theme name %r, using %s" % (record["name"], entry.path), file=sys.stderr)
+        records[record["name"]] = record
+
+    records = list(records.values())
+    slots = 1
+    while slots < 2 * len(records):
+        slots *= 2
+    table = [0] * slots
+    for i, record in enumerate(records):
+        slot = _index_name_hash(record["name"]) % slots
+        while table[slot]:
+            slot = (slot + 1) % slots
+        table[slot] = i + 1
+
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(THEME_INDEX_HEADER.pack(THEME_INDEX_MAGIC, PALETTE_ALGORITHM_VERSION,
+            len(records), slots, precision, search.encode()))
+        for record in records:
+            f.write(THEME_INDEX_RECORD.pack(
+                record["name"].encode(),
+                record["source"].encode(),
+                record["mtime"],
+                record["size"],
+                record["sha256"],
+                record["colors"],
+                record["palette"],
+            ))
+        f.write(struct.pack("<%dI" % slots, *table))
+    os.replace(tmp, path)
+    return len(records), rebuilt
+
+def osc_color(type_index, palette_index, rgb):
     codes = [str(type_index)]
     if palette_index is not None:
         codes.append(str(palette_index))
-    codes.append("rgb:" + "/".join(f"{c:02x}" for c in hex_to_rgb(color)))
-    print(f"\033]{';'.join(codes)}\033\\", end="")
+    codes.append("rgb:" + "/".join(f"{c:02x}" for c in rgb))
+    return f"\033]{';'.join(codes)}\033\\"
+
+def load_named_theme(fname, index=None, adjust=None, cache=None, search="bisect", precision=0.01):
+    # Loads fname from disk, or by theme name from index when no such
+    # file exists.
+    if index is not None and not os.path.exists(fname):
+        theme = index.load(fname, adjust, cache, search=search, precision=precision)
+        if theme is None:
+            raise LookupError("No theme named %r in %s" % (fname, index.path))
+        return theme
+    return load_theme(fname, adjust, cache, search=search, precision=precision)
+
+def _theme_job(fname, options):
+    # Process pool worker for --jobs: loads one theme and renders its
+    # outputs. Errors are returned rather than raised so every file is
+    # reported.
+    try:
+        index = ThemeIndex(options["index"]) if options["index"] else None
+        cache = PaletteCache(options["cache_dir"]) if options["cache_dir"] else None
+        theme = load_named_theme(
+            fname,
+            index,
+            options["adjust"],
+            cache,
+            search=options["search"],
+            precision=options["precision"],
+        )
+        rendered = render_theme_outputs(
+            theme, options["targets"], options["output"], options["output_template"])
+        return theme, rendered, None
+    except Exception as e:
+        return None, None, "%s: %s" % (fname, e)
 
-def apply_theme(theme):
-    for i, color in enumerate(theme.palette):
-        apply_color(4, i, color)
-    apply_color(10, None, theme.fg)
-    apply_color(11, None, theme.bg)
-    apply_color(12, None, theme.fg)
+def apply_color(type_index, palette_index, color):
+    print(osc_color(type_index, palette_index, hex_to_rgb(color)), end="")
+
+def theme_osc_colors(theme):
+    # (OSC number, palette index, rgb) for every color apply_theme sets.
+    raw = theme.buffer()
+    colors = [(4, i, tuple(raw[3*i:3*i + 3])) for i in range(len(theme))]
+    colors.append((10, None, tuple(raw[-3:])))
+    colors.append((11, None, tuple(raw[-6:-3])))
+    colors.append((12, None, tuple(raw[-3:])))
+    return colors
+
+OSC_REPLY_RE = re.compile(
+    rb"\033\](\d+);(?:(\d+);)?rgb:([0-9a-fA-F]+)/([0-9a-fA-F]+)/([0-9a-fA-F]+)(?:\033\\|\007)")
+DA1_REPLY_RE = re.compile(rb"\033\[\?[0-9;]*c")
+
+def _scale_channel(digits):
+    return round(int(digits, 16) * 255 / (16 ** len(digits) - 1))
+
+def query_terminal_colors(keys, timeout=0.5):
+    # Asks the terminal for the colors behind keys, (OSC number, palette
+    # index) pairs, and returns {key: rgb} for those it answered. A
+    # trailing primary device attributes request marks the end of the
+    # replies, so terminals that ignore the queries don't cost the full
+    # timeout. Returns {} when there is no terminal to ask.
+    try:
+        fd = os.open("/dev/tty", os.O_RDWR | os.O_NOCTTY)
+    except OSError:
+        return {}
+    queries = []
+    for type_index, palette_index in keys:
+        if palette_index is None:
+            queries.append(f"\033]{type_index};?\033\\")
+        else:
+            queries.append(f"\033]{type_index};{palette_index};?\033\\")
+    queries.append("\033[c")
+    old_settings = termios.tcgetattr(fd)
+    reply = b""
+    try:
+        tty.setraw(fd, termios.TCSANOW)
+        os.write(fd, "".join(queries).encode())
+        deadline = time.monotonic() + timeout
+        while not DA1_REPLY_RE.search(reply):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                break
+            reply += os.read(fd, 65536)
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
+        os.close(fd)
+    colors = {}
+    for match in OSC_REPLY_RE.finditer(reply):
+        palette_index = int(match.group(2)) if match.group(2) is not None else None
+        colors[(int(match.group(1)), palette_index)] = \
+            tuple(_scale_channel(match.group(i)) for i in (3, 4, 5))
+    return colors
+
+TRANSITION_FPS = 60
+
+def parse_duration(value):
+    # "300ms", "0.3s" or a bare number of milliseconds -> seconds
+    try:
+        if value.endswith("ms"):
+            return float(value[:-2]) / 1000
+        if value.endswith("s"):
+            return float(value[:-1])
+        return float(value) / 1000
+    except ValueError:
+        raise ArgumentTypeError("invalid duration %r" % value)
+
+def transition_frames(start, end, count):
+    # Packed sRGB frames moving from start to end (packed sRGB of the same
+    # length) along a smoothstep curve in LAB. All frames are converted
+    # in one batch; the last frame is exactly end.
+    start_lab = srgb_to_lab(start)
+    end_lab = srgb_to_lab(end)
+    lab = array('d')
+    for k in range(1, count):
+        t = k / count
+        t = t * t * (3 - 2 * t)
+        lab.extend(s + (e - s) * t for s, e in zip(start_lab, end_lab))
+    srgb = lab_to_srgb(lab)
+    size = len(end)
+    return [srgb[i:i + size] for i in range(0, len(srgb), size)] + [bytes(end)]
+
+def write_osc_frame(colors, rgb, previous=None):
+    # Writes the entries of packed sRGB frame rgb that differ from the
+    # previous frame in a single write.
+    payload = "".join(
+        osc_color(type_index, palette_index, rgb[3*i:3*i + 3])
+        for i, (type_index, palette_index, _) in enumerate(colors)
+        if previous is None or previous[3*i:3*i + 3] != rgb[3*i:3*i + 3]
+    )
+    if payload:
+        sys.stdout.buffer.write(payload.encode())
+        sys.stdout.flush()
+
+def apply_theme(theme, diff=False, timeout=0.5, transition=None):
+    # Sends every sequence in one write. With diff, the terminal's current
+    # colors are queried first and only the differing ones are sent. With
+    # a transition duration in seconds, the current colors are faded to
+    # the theme over TRANSITION_FPS frames per second.
+    colors = theme_osc_colors(theme)
+    target = bytes(c for _, _, rgb in colors for c in rgb)
+    current = {}
+    if diff or transition:
+        current = query_terminal_colors(
+            [(type_index, palette_index) for type_index, palette_index, _ in colors],
+            timeout,
+        )
+    sys.stdout.flush()
+    if not transition or not current:
+        payload = "".join(
+            osc_color(type_index, palette_index, rgb)
+            for type_index, palette_index, rgb in colors
+            if current.get((type_index, palette_index)) != rgb
+        )
+        sys.stdout.buffer.write(payload.encode())
+        sys.stdout.flush()
+        return
 
-def generate_base8_theme(theme):
-    buffer = [];
-    buffer.append("#%s" % theme.bg)
+    start = bytes(
+        c for type_index, palette_index, rgb in colors
+        for c in current.get((type_index, palette_index), rgb)
+    )
+    frames = transition_frames(start, target, max(1, round(transition * TRANSITION_FPS)))
+    previous = start
+    began = time.monotonic()
+    for k, frame in enumerate(frames):
+        now = time.monotonic()
+        deadline = began + (k + 1) / TRANSITION_FPS
+        if now > deadline and k != len(frames) - 1:
+            continue
+        write_osc_frame(colors, frame, previous)
+        previous = frame
+        time.sleep(max(0, deadline - time.monotonic()))
+
+# Recolor filter: rewrites the SGR color sequences of a byte stream as
+# it passes through. Truecolor (38;2;r;g;b / 48;2;r;g;b) becomes the
+# nearest palette index; with a source theme, 38;5;n / 48;5;n are moved
+# to the index closest to the source theme's color n.
+
+SGR_RE = re.compile(rb"\x1b\[([0-9;]*)m")
+SGR_PARTIAL_RE = re.compile(rb"\x1b(?:\[[0-9;]*)?")
+RECOLOR_CHUNK_SIZE = 1 << 16
+RECOLOR_MAX_SEQUENCE = 256
+RECOLOR_MEMO_MAX = 4096
+
+def recolor_sgr(params, nearest, remap=None):
+    # Extended colors are handled as whole units, 38;5;n or 38;2;r;g;b,
+    # and copied through unchanged when they are not rewritten, so their
+    # arguments are never read as codes of their own.
+    parts = params.split(b";")
+    out = []
+    i = 0
+    while i < len(parts):
+        code = parts[i]
+        mode = parts[i + 1] if i + 1 < len(parts) else None
+        if code not in (b"38", b"48") or mode not in (b"2", b"5"):
+            out.append(code)
+            i += 1
+            continue
+        size = 5 if mode == b"2" else 3
+        unit = parts[i:i + size]
+        i += size
+        try:
+            if mode == b"2" and len(unit) == 5:
+                rgb = [int(c) for c in unit[2:]]
+                if max(rgb) < 256:
+                    unit = [code, b"5", b"%d" % nearest(*rgb)]
+            elif remap is not None and len(unit) == 3:
+                index = int(unit[2])
+                if index < len(remap):
+                    unit = [code, b"5", b"%d" % remap[index]]
+        except ValueError:
+            pass
+        out += unit
+    return b";".join(out)
+
+def recolor_stream(source, sink, theme, from_theme=None, cache=None,
+        chunk_size=RECOLOR_CHUNK_SIZE):
+    # Reads whatever is available up to chunk_size at a time. An escape
+    # sequence cut off at the end of a chunk is held back and completed
+    # by the next one. Rewritten sequences are memoized whole.
+    nearest = theme.nearest_grid(cache).lookup
+    remap = None
+    if from_theme is not None:
+        remap = theme.nearest_many(from_theme.buffer()[:-6])
+    memo = {}
+
+    def rewrite(match):
+        sequence = match.group(0)
+        result = memo.get(sequence)
+        if result is None:
+            if len(memo) >= RECOLOR_MEMO_MAX:
+                memo.clear()
+            result = memo[sequence] = b"\x1b[%sm" % recolor_sgr(match.group(1), nearest, remap)
+        return result
+
+    pending = b""
+    while True:
+        chunk = source.read1(chunk_size)
+        if not chunk:
+            break
+        data = pending + chunk
+        cut = data.rfind(b"\x1b", -RECOLOR_MAX_SEQUENCE)
+        if cut != -1 and SGR_PARTIAL_RE.fullmatch(data, cut):
+            data, pending = data[:cut], data[cut:]
+        else:
+            pending = b""
+        sink.write(SGR_RE.sub(rewrite, data))
+        sink.flush()
+    sink.write(pending)
+    sink.flush()
+
+# Emitters stream pre-encoded lines into a binary sink with one write.
+# Per-color lines are precompiled into (prefix, suffix) byte pairs around
+# the hex color; generate_*_theme wraps each writer to return a str.
+
+def color_line_templates(template, args):
+    return [tuple((template % arg).encode().split(b"\0")) for arg in args]
+
+def fill_color_lines(templates, colors):
+    return [prefix + color + suffix for (prefix, suffix), color in zip(templates, colors)]
+
+def theme_hex_bytes(theme):
+    # Hex of every palette entry followed by bg and fg, as ASCII bytes.
+    h = theme.buffer().hex().encode()
+    return [h[i:i + 6] for i in range(0, len(h), 6)]
+
+ALACRITTY_COLOR_NAMES = ["black", "red", "green", "yellow", "blue", "magenta", "cyan", "white"]
+
+KITTY_LINES = color_line_templates("color%d #\0", range(256))
+GHOSTTY_LINES = color_line_templates("palette = %d = #\0", range(256))
+WEZTERM_ANSI_LINES = [(b'        "#', b'",')] * 16
+WEZTERM_INDEXED_LINES = color_line_templates('        [%d] = "#\0",', range(16, 256))
+ALACRITTY_BASE_LINES = color_line_templates("%s = '#\0'", ALACRITTY_COLOR_NAMES * 2)
+ALACRITTY_INDEXED_LINES = color_line_templates("    { index = %d, color = '#\0' },", range(16, 256))
+FOOT_LINES = (
+    color_line_templates("regular%d=\0", range(8))
+    + color_line_templates("bright%d=\0", range(8))
+    + color_line_templates("%d=\0", range(16, 256))
+)
+XRESOURCES_LINES = color_line_templates("*.color%d: #\0", range(256))
+ST_LINES = [(b'\t"#', b'",')] * 258
+
+def write_base8_theme(theme, sink):
+    colors = theme_hex_bytes(theme)
+    lines = [b"#" + colors[-2]]
     for i in range(1, 7):
-        buffer.append("#%s" % theme[i])
-    buffer.append("#%s" % theme.fg)
-    return "\n".join(buffer)
+        lines.append(b"#" + colors[i])
+    lines.append(b"#" + colors[-1])
+    sink.write(b"\n".join(lines))
+
+def write_kitty_theme(theme, sink):
+    colors = theme_hex_bytes(theme)
+    lines = [
+        b"background #" + colors[-2],
+        b"foreground #" + colors[-1],
+        b"cursor #" + colors[-1],
+        b"selection_background #" + theme.selection.encode(),
+        b"selection_foreground none",
+    ]
+    lines += fill_color_lines(KITTY_LINES, colors[:256])
+    sink.write(b"\n".join(lines))
+
+def write_ghostty_theme(theme, sink):
+    colors = theme_hex_bytes(theme)
+    lines = [
+        b"background = #" + colors[-2],
+        b"foreground = #" + colors[-1],
+        b"cursor = #" + colors[-1],
+        b"selection-background = #" + theme.selection.encode(),
+        b"selection-foreground = cell-foreground",
+    ]
+    lines += fill_color_lines(GHOSTTY_LINES, colors[:256])
+    sink.write(b"\n".join(lines))
+
+def write_wezterm_theme(theme, sink):
+    colors = theme_hex_bytes(theme)
+    lines = [
+        b"colors = {",
+        b'    background = "#%s",' % colors[-2],
+        b'    foreground = "#%s",' % colors[-1],
+        b'    cursor_bg = "#%s",' % colors[-1],
+        b'    cursor_border = "#%s",' % colors[-1],
+        b"    ansi = {",
+    ]
+    lines += fill_color_lines(WEZTERM_ANSI_LINES[:8], colors[:8])
+    lines += [b"    },", b"    brights = {"]
+    lines += fill_color_lines(WEZTERM_ANSI_LINES[8:], colors[8:16])
+    lines += [b"    },", b"    indexed = {"]
+    lines += fill_color_lines(WEZTERM_INDEXED_LINES, colors[16:256])
+    lines += [b"    }", b"}"]
+    sink.write(b"\n".join(lines))
+
+def write_alacritty_theme(theme, sink):
+    colors = theme_hex_bytes(theme)
+    lines = [
+        b"[colors.primary]",
+        b"background = '#%s'" % colors[-2],
+        b"foreground = '#%s'" % colors[-1],
+        b"cursor = { text = 'CellForeground', cursor = '#%s' }" % colors[-1],
+        b"selection = { text = 'CellForeground', background = '#%s' }" % theme.selection.encode(),
+        b"[colors.normal]",
+    ]
+    lines += fill_color_lines(ALACRITTY_BASE_LINES[:8], colors[:8])
+    lines.append(b"[colors.bright]")
+    lines += fill_color_lines(ALACRITTY_BASE_LINES[8:], colors[8:16])
+    lines.append(b"indexed_colors = [")
+    lines += fill_color_lines(ALACRITTY_INDEXED_LINES, colors[16:256])
+    lines.append(b"]")
+    sink.write(b"\n".join(lines))
+
+def write_foot_theme(theme, sink):
+    colors = theme_hex_bytes(theme)
+    lines = [
+        b"[colors]",
+        b"background=" + colors[-2],
+        b"foreground=" + colors[-1],
+        b"cursor=%s %s" % (colors[-2], colors[-1]),
+        b"selection-background=" + theme.selection.encode(),
+    ]
+    lines += fill_color_lines(FOOT_LINES, colors[:256])
+    sink.write(b"\n".join(lines))
+
+# https://github.com/Roliga/urxvt-xresources-256
+def write_xresources_theme(theme, sink):
+    colors = theme_hex_bytes(theme)
+    lines = [
+        b"*.foreground: #" + colors[-1],
+        b"*.background: #" + colors[-2],
+        b"*.cursorColor: #" + colors[-1],
+    ]
+    lines += fill_color_lines(XRESOURCES_LINES, colors[:256])
+    sink.write(b"\n".join(lines))
+
+def write_st_theme(theme, sink):
+    colors = theme_hex_bytes(theme)
+    lines = [b"static const char *colorname[] = {"]
+    lines += fill_color_lines(ST_LINES, colors[:256] + colors[-2:])
+    lines += [
+        b"};",
+        b"unsigned int defaultbg = 256;",
+        b"unsigned int defaultfg = 257;",
+        b"static unsigned int defaultcs = 257;",
+    ]
+    sink.write(b"\n".join(lines))
+
+WRITE_LOOKUP = {
+    'base8': write_base8_theme,
+    'kitty': write_kitty_theme,
+    'ghostty': write_ghostty_theme,
+    'wezterm': write_wezterm_theme,
+    'alacritty': write_alacritty_theme,
+    'foot': write_foot_theme,
+    'xresources': write_xresources_theme,
+    'st': write_st_theme,
+}
+
+def generate_theme(fmt, theme):
+    sink = io.BytesIO()
+    WRITE_LOOKUP[fmt](theme, sink)
+    return sink.getvalue().decode()
+
+def generate_base8_theme(theme):
+    return generate_theme('base8', theme)
 
 def generate_kitty_theme(theme):
-    buffer = [];
-    buffer.append("background #%s" % theme.bg)
-    buffer.append("foreground #%s" % theme.fg)
-    buffer.append("cursor #%s" % theme.fg)
-    buffer.append("selection_background #%s" % theme.selection)
-    buffer.append("selection_foreground none")
-    for i in range(0, 256):
-        buffer.append("color%d #%s" % (i, theme[i]))
-    return "\n".join(buffer)
+    return generate_theme('kitty', theme)
 
 def generate_ghostty_theme(theme):
-    buffer = [];
-    buffer.append("background = #%s" % theme.bg)
-    buffer.append("foreground = #%s" % theme.fg)
-    buffer.append("cursor = #%s" % theme.fg)
-    buffer.append("selection-background = #%s" % theme.selection)
-    buffer.append("selection-foreground = cell-foreground")
-    for i in range(0, 256):
-        buffer.append("palette = %d = #%s" % (i, theme[i]))
-    return "\n".join(buffer)
+    return generate_theme('ghostty', theme)
 
 def generate_wezterm_theme(theme):
-    buffer = [];
-    buffer.append("colors = {")
-    buffer.append('    background = "#%s",' % theme.bg)
-    buffer.append('    foreground = "#%s",' % theme.fg)
-    buffer.append('    cursor_bg = "#%s",' % theme.fg)
-    buffer.append('    cursor_border = "#%s",' % theme.fg)
-    buffer.append('    ansi = {')
-    for i in range(0, 8):
-        buffer.append('        "#%s",' % theme[i])
-    buffer.append('    },')
-    buffer.append('    brights = {')
-    for i in range(8, 16):
-        buffer.append('        "#%s",' % theme[i])
-    buffer.append('    },')
-    buffer.append('    indexed = {')
-    for i in range(16, 256):
-        buffer.append('        [%d] = "#%s",' % (i, theme[i]))
-    buffer.append('    }')
-    buffer.append('}')
-    return "\n".join(buffer)
+    return generate_theme('wezterm', theme)
 
 def generate_alacritty_theme(theme):
-    buffer = []
-    buffer.append("[colors.primary]")
-    buffer.append("background = '#%s'" % theme.bg)
-    buffer.append("foreground = '#%s'" % theme.fg)
-    buffer.append("cursor = { text = 'CellForeground', cursor = '#%s' }" % theme.fg)
-    buffer.append("selection = { text = 'CellForeground', background = '#%s' }" % theme.selection)
-    buffer.append("[colors.normal]")
-    color_names = ["black", "red", "green", "yellow", "blue", "magenta", "cyan", "white"]
-    for i in range(0, 8):
-        buffer.append("%s = '#%s'" % (color_names[i], theme[i]))
-    buffer.append("[colors.bright]")
-    for i in range(8, 16):
-        buffer.append("%s = '#%s'" % (color_names[i-8], theme[i]))
-    buffer.append("indexed_colors = [")
-    for i in range(16, 256):
-        buffer.append("    { index = %d, color = '#%s' }," % (i, theme[i]))
-    buffer.append("]")
-    return "\n".join(buffer)
+    return generate_theme('alacritty', theme)
 
 def generate_foot_theme(theme):
-    buffer = []
-    buffer.append("[colors]")
-    buffer.append("background=%s" % theme.bg)
-    buffer.append("foreground=%s" % theme.fg)
-    buffer.append("cursor=%s %s" % (theme.bg, theme.fg))
-    buffer.append("selection-background=%s" % theme.selection)
-    for i in range(0, 8):
-        buffer.append("regular%d=%s" % (i, theme[i]))
-    for i in range(8, 16):
-        buffer.append("bright%d=%s" % (i-8, theme[i]))
-    for i in range(16, 256):
-        buffer.append("%d=%s" % (i, theme[i]))
-    return "\n".join(buffer)
+    return generate_theme('foot', theme)
 
-# https://github.com/Roliga/urxvt-xresources-256
 def generate_xresources_theme(theme):
-    buffer = []
-    buffer.append("*.foreground: #%s" % theme.fg)
-    buffer.append("*.background: #%s" % theme.bg)
-    buffer.append("*.cursorColor: #%s" % theme.fg)
-    for i in range(256):
-        buffer.append("*.color%d: #%s" % (i, theme[i]))
-    return "\n".join(buffer)
+    return generate_theme('xresources', theme)
 
 def generate_st_theme(theme):
-    buffer = []
-    buffer.append("static const char *colorname[] = {")
-    for i in range(256):
-        buffer.append('\t"#%s",' % theme[i])
-    buffer.append('\t"#%s",' % theme.bg)
-    buffer.append('\t"#%s",' % theme.fg)
-    buffer.append("};")
-    buffer.append("unsigned int defaultbg = 256;");
-    buffer.append("unsigned int defaultfg = 257;");
-    buffer.append("static unsigned int defaultcs = 257;");
-    return "\n".join(buffer)
+    return generate_theme('st', theme)
 
 GENERATE_LOOKUP = {
     'base8': generate_base8_theme,
@@ -577,6 +1646,108 @@ GENERATE_LOOKUP = {
     'st': generate_st_theme,
 }
 
+def parse_generate_targets(value):
+    # "kitty,foot" or "kitty=~/.config/kitty/{name}.conf,foot" -> a list
+    # of (format, path template or None).
+    targets = []
+    for item in value.split(","):
+        fmt, _, path = item.partition("=")
+        fmt = fmt.strip()
+        if fmt not in GENERATE_LOOKUP:
+            raise ArgumentTypeError("invalid format %r (choose from %s)"
+                % (fmt, ", ".join(GENERATE_LOOKUP)))
+        if path:
+            check_path_template(path)
+        targets.append((fmt, path or None))
+    return targets
+
+def check_path_template(path):
+    try:
+        path.format(name="", format="")
+    except (KeyError, IndexError, ValueError) as e:
+        raise ArgumentTypeError("invalid path template %r: only {name} and {format} "
+            "may be used (%s: %s)" % (path, type(e).__name__, e))
+    return path
+
+def generate_output_path(theme, fmt, path, output=None, output_template=None):
+    if path is None:
+        path = output_template
+    if path is not None:
+        return os.path.expanduser(path.format(name=theme.name, format=fmt))
+    if output is not None:
+        return os.path.join(output or ".", theme.name + "." + fmt + ".txt")
+    return None
+
+def write_if_changed(fname, data):
+    # Leaves fname untouched (mtime included) when it already holds data;
+    # otherwise replaces it atomically. Returns whether it was written.
+    # Symlinks are followed so the file they point at is the one replaced.
+    fname = os.path.realpath(fname)
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        stat = None
+    if stat is not None and stat.st_size == len(data):
+        with open(fname, "rb") as f:
+            if f.read() == data:
+                return False
+    os.makedirs(os.path.dirname(fname) or ".", exist_ok=True)
+    tmp = "%s.%d.tmp" % (fname, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        if stat is not None:
+            os.chmod(tmp, stat.st_mode & 0o7777)
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return True
+
+def render_theme_outputs(theme, targets, output=None, output_template=None):
+    # (format, path or None for stdout, rendered bytes) for every target.
+    # Path templates stand in for "main.py --generate fmt > path", so those
+    # files end in a newline like the printed output does.
+    rendered = []
+    for fmt, path in targets:
+        sink = io.BytesIO()
+        WRITE_LOOKUP[fmt](theme, sink)
+        if path is not None or output_template is not None:
+            sink.write(b"\n")
+        rendered.append((
+            fmt,
+            generate_output_path(theme, fmt, path, output, output_template),
+            sink.getvalue(),
+        ))
+    return rendered
+
+def write_theme_outputs(theme, targets, output=None, output_template=None, status=None,
+        rendered=None):
+    # Returns (theme name, format, path, changed) for every file target.
+    if rendered is None:
+        rendered = render_theme_outputs(theme, targets, output, output_template)
+    results = []
+    for fmt, fname, data in rendered:
+        if fname is None:
+            print(data.decode())
+            continue
+        changed = write_if_changed(fname, data)
+        print("generated" if changed else "unchanged", fname, file=status or sys.stdout)
+        results.append((theme.name, fmt, fname, changed))
+    return results
+
+def write_manifest(fname, results):
+    manifest = {"changed": {}, "unchanged": {}}
+    for _, fmt, path, changed in results:
+        manifest["changed" if changed else "unchanged"].setdefault(fmt, []).append(path)
+    data = json.dumps(manifest, indent=4) + "\n"
+    if fname == "-":
+        sys.stdout.write(data)
+    else:
+        with open(fname, "w") as f:
+            f.write(data)
+
 def preview_theme(name, palette, fg=None, bg=None):
     def color_str(index, text, background=True):
         hex_color = bg if index is None else palette[index]
@@ -741,49 +1912,406 @@ BASELINE_GREYSCALE = [
 BASELINE_THEME = Theme("Default",
     BASELINE_BASE_16 + BASELINE_RGB + BASELINE_GREYSCALE)
 
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "color256.sock")
+    return "/tmp/color256-%d.sock" % os.getuid()
+
+def theme_to_json(theme):
+    return {"name": theme.name, "palette": theme.palette, "bg": theme.bg, "fg": theme.fg}
+
+def theme_from_json(data):
+    return Theme(data["name"], data["palette"], bg=data["bg"], fg=data["fg"])
+
+class PaletteServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # Long-running palette service. Each connection sends JSON requests,
+    # one per line, and gets one JSON response line for each:
+    #
+    #   {"op": "theme", "file": PATH}              -> theme
+    #   {"op": "palette", "colors": [16 hex], "bg": HEX, "fg": HEX}
+    #                                              -> theme
+    #   {"op": "generate", "format": FMT, "file": PATH}
+    #                                              -> {"output": TEXT}
+    #
+    # where a theme is {"name", "palette", "bg", "fg"}. Requests may also
+    # carry "adjust_lightness", "search" and "precision". Errors come back
+    # as {"error": MESSAGE}.
+    #
+    # Each connection gets its own thread, so an idle client does not hold
+    # up the others.
+    MAX_THEMES = 256
+    daemon_threads = True
+
+    def __init__(self, path, cache=None):
+        self.path = path
+        self.cache = cache
+        self.themes = OrderedDict()
+        self.themes_lock = threading.Lock()
+        if os.path.exists(path):
+            with socket.socket(socket.AF_UNIX) as probe:
+                try:
+                    probe.connect(path)
+                except OSError:
+                    os.remove(path)
+                else:
+                    raise RuntimeError("a daemon is already listening on %s" % path)
+        old_umask = os.umask(0o077)
+        try:
+            super().__init__(path, PaletteRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _remember(self, key, build):
+        # Built outside the lock so a slow palette does not stall lookups;
+        # two threads racing on one key both build and the last one wins.
+        with self.themes_lock:
+            theme = self.themes.get(key)
+            if theme is not None:
+                self.themes.move_to_end(key)
+                return theme
+        theme = build()
+        with self.themes_lock:
+            self.themes[key] = theme
+            if len(self.themes) > self.MAX_THEMES:
+                self.themes.popitem(last=False)
+        return theme
+
+    def theme(self, request):
+        adjust = request.get("adjust_lightness")
+        search = request.get("search", "bisect")
+        precision = request.get("precision", 0.01)
+        if "file" in request:
+            fname = os.path.abspath(request["file"])
+            stat = os.stat(fname)
+            key = ("file", fname, stat.st_mtime_ns, stat.st_size, adjust, search, precision)
+            return self._remember(key, lambda: load_theme(
+                fname, adjust, self.cache, search=search, precision=precision))
+        colors = request["colors"]
+        if not 8 <= len(colors) <= 16:
+            raise ValueError("expected 8 to 16 colors, got %d" % len(colors))
+        # Missing bright colors repeat their normal counterpart, as in
+        # parse_theme.
+        colors = list(colors) + list(colors[len(colors) - 8:8])
+        key = ("colors", tuple(colors), request.get("bg"), request.get("fg"),
+            adjust, search, precision)
+        def build():
+            theme = Theme(request.get("name", "palette"), colors,
+                bg=request.get("bg"), fg=request.get("fg"))
+            if adjust is not None:
+                adjust_theme_lightness(theme, adjust)
+            generate_palette_cached(theme, self.cache, search=search, precision=precision)
+            return theme
+        return self._remember(key, build)
+
+    def handle_request_data(self, request):
+        op = request.get("op")
+        if op in ("theme", "palette"):
+            return theme_to_json(self.theme(request))
+        elif op == "generate":
+            return {"output": GENERATE_LOOKUP[request["format"]](self.theme(request))}
+        raise ValueError("unknown op %r" % op)
+
+class PaletteRequestHandler(socketserver.StreamRequestHandler):
+    timeout = 30
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.handle_request_data(json.loads(line))
+            except Exception as e:
+                response = {"error": "%s: %s" % (type(e).__name__, e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+def serve(path, cache=None):
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with PaletteServer(path, cache) as server:
+        print("listening on", path, file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+def request_daemon(path, requests):
+    # Returns one response per request, or None if no daemon is running.
+    try:
+        sock = socket.socket(socket.AF_UNIX)
+        sock.connect(path)
+    except OSError:
+        return None
+    with sock, sock.makefile("rwb") as f:
+        for request in requests:
+            f.write(json.dumps(request).encode() + b"\n")
+        f.flush()
+        sock.shutdown(socket.SHUT_WR)
+        responses = [json.loads(line) for line in f]
+    for response in responses:
+        if "error" in response:
+            raise RuntimeError(response["error"])
+    return responses
+
+WATCH_INTERVAL = 0.25
+WATCH_DEBOUNCE = 0.3
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def watch_files(paths, callback, interval=WATCH_INTERVAL, debounce=WATCH_DEBOUNCE):
+    # Polls the files' mtime and size every `interval` seconds. A changed
+    # file is reported once it has stayed unchanged for `debounce`
+    # seconds, so a burst of writes triggers a single callback.
+    seen = {path: file_signature(path) for path in paths}
+    pending = {}
+    while True:
+        time.sleep(interval)
+        now = time.monotonic()
+        for path in paths:
+            signature = file_signature(path)
+            if signature != seen[path]:
+                seen[path] = signature
+                pending[path] = now
+        for path, changed in list(pending.items()):
+            if now - changed >= debounce:
+                del pending[path]
+                if seen[path] is not None:
+                    callback(path)
+
+def watch_themes(filenames, regenerate, noctalia=None):
+    def on_change(path):
+        try:
+            if path == noctalia:
+                from convert_noctalia import convert_noctalia_to_color256
+                convert_noctalia_to_color256(noctalia, filenames[0])
+            else:
+                regenerate(path)
+        except Exception as e:
+            print("failed to regenerate %s: %s" % (path, e), file=sys.stderr)
+
+    paths = list(filenames)
+    if noctalia is not None:
+        paths.append(noctalia)
+    print("watching", ", ".join(paths), file=sys.stderr)
+    watch_files(paths, on_change)
+
 def main():
     parser = ArgumentParser()
     parser.add_argument("filenames", nargs="*")
-    parser.add_argument("--generate", choices=GENERATE_LOOKUP)
+    parser.add_argument("--generate", type=parse_generate_targets,
+        metavar="FORMAT[=PATH][,...]",
+        help="comma separated formats (%s); PATH may use {name} and {format}"
+            % ", ".join(GENERATE_LOOKUP))
     parser.add_argument("--output", type=str)
+    parser.add_argument("--output-template", type=check_path_template,
+        help="output path for formats without =PATH, e.g. '{name}.{format}.conf'")
     parser.add_argument("--baseline", action="store_true")
     parser.add_argument("--adjust-lightness", type=int)
+    parser.add_argument("--contrast-search", choices=("bisect", "linear"), default="bisect")
+    parser.add_argument("--contrast-precision", type=parse_precision, default=0.01)
     parser.add_argument("--apply", action="store_true")
+    parser.add_argument("--diff", action="store_true",
+        help="with --apply, query the terminal and only send colors that differ")
+    parser.add_argument("--transition", type=parse_duration, metavar="DURATION",
+        help="with --apply, fade from the current colors over DURATION (e.g. 300ms)")
+    parser.add_argument("--query-timeout", type=float, default=0.5,
+        help="seconds to wait for the terminal to answer color queries")
+    parser.add_argument("--cache-dir", type=str,
+        default=os.environ.get("COLOR256_CACHE_DIR"),
+        help="cache generated palettes in this directory (default: $COLOR256_CACHE_DIR)")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--serve", action="store_true",
+        help="run a palette daemon on --socket")
+    parser.add_argument("--client", action="store_true",
+        help="load themes through the daemon on --socket, if one is running")
+    parser.add_argument("--socket", type=str, default=default_socket_path())
+    parser.add_argument("--jobs", "-j", type=int, default=1, metavar="N",
+        help="load, generate and render themes in N worker processes")
+    parser.add_argument("--manifest", type=str, metavar="PATH",
+        help="write a JSON manifest of changed and unchanged output files ('-' for stdout)")
+    parser.add_argument("--build-index", type=str, metavar="DIR",
+        help="compile the theme files in DIR into a binary index and exit")
+    parser.add_argument("--index", type=str, metavar="PATH",
+        help="theme index to look up filenames that are not files (default for --build-index: DIR/%s)"
+            % THEME_INDEX_NAME)
+    parser.add_argument("--recolor", type=str, metavar="THEME",
+        help="filter stdin to stdout, mapping truecolor SGR colors to THEME's 256-color palette")
+    parser.add_argument("--recolor-from", type=str, metavar="THEME",
+        help="with --recolor, also move 256-color indices from THEME's palette to the closest in --recolor's")
+    parser.add_argument("--watch", action="store_true",
+        help="keep running and regenerate outputs when a theme file changes")
+    parser.add_argument("--noctalia", type=str, metavar="COLORS_JSON",
+        help="with --watch, convert this noctalia colors.json into the theme file on change")
     ns = parser.parse_args()
-    
-    themes = list(map(parse_theme, ns.filenames))
+
+    if ns.watch and not ns.generate:
+        parser.error("--watch requires --generate")
+    if ns.watch and ns.output is None and ns.output_template is None and any(
+            path is None for _, path in ns.generate):
+        parser.error("--watch needs an output path for every format")
+    if ns.noctalia and (not ns.watch or len(ns.filenames) != 1):
+        parser.error("--noctalia requires --watch and exactly one theme file")
+    if ns.recolor_from and not ns.recolor:
+        parser.error("--recolor-from requires --recolor")
+
+    cache = None
+    if ns.cache_dir and not ns.no_cache:
+        cache = PaletteCache(os.path.expanduser(ns.cache_dir))
+
+    if ns.build_index is not None:
+        count, rebuilt = build_theme_index(
+            ns.build_index,
+            ns.index,
+            search=ns.contrast_search,
+            precision=ns.contrast_precision,
+        )
+        print("indexed %d themes (%d rebuilt)" % (count, rebuilt))
+        return
+
+    if ns.serve:
+        try:
+            serve(ns.socket, cache)
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            exit(1)
+        return
+
+    try:
+        index = ThemeIndex(ns.index) if ns.index else None
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        exit(1)
+    if ns.recolor:
+        try:
+            theme, from_theme = [
+                load_named_theme(
+                    fname,
+                    index,
+                    ns.adjust_lightness,
+                    cache,
+                    search=ns.contrast_search,
+                    precision=ns.contrast_precision,
+                ) if fname else None
+                for fname in (ns.recolor, ns.recolor_from)
+            ]
+        except LookupError as e:
+            print(e.args[0], file=sys.stderr)
+            exit(1)
+        try:
+            recolor_stream(sys.stdin.buffer, sys.stdout.buffer, theme, from_theme, cache)
+        except (BrokenPipeError, KeyboardInterrupt):
+            pass
+        return
+
+    responses = None
+    if ns.client and ns.filenames:
+        try:
+            responses = request_daemon(ns.socket, [{
+                "op": "theme",
+                "file": os.path.abspath(fname),
+                "adjust_lightness": ns.adjust_lightness,
+                "search": ns.contrast_search,
+                "precision": ns.contrast_precision,
+            } for fname in ns.filenames])
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            exit(1)
+
+    rendered = {}
+    failed = False
+    if responses is not None:
+        themes = list(map(theme_from_json, responses))
+    elif ns.jobs > 1 and len(ns.filenames) > 1:
+        options = {
+            "index": ns.index,
+            "cache_dir": cache.directory if cache else None,
+            "adjust": ns.adjust_lightness,
+            "search": ns.contrast_search,
+            "precision": ns.contrast_precision,
+            "targets": ns.generate or [],
+            "output": ns.output,
+            "output_template": ns.output_template,
+        }
+        themes = []
+        with ProcessPoolExecutor(ns.jobs) as pool:
+            jobs = pool.map(_theme_job, ns.filenames, [options] * len(ns.filenames))
+            for theme, theme_outputs, error in jobs:
+                if error is not None:
+                    print(error, file=sys.stderr)
+                    failed = True
+                    continue
+                rendered[id(theme)] = theme_outputs
+                themes.append(theme)
+    else:
+        try:
+            themes = [
+                load_named_theme(
+                    fname,
+                    index,
+                    ns.adjust_lightness,
+                    cache,
+                    search=ns.contrast_search,
+                    precision=ns.contrast_precision,
+                )
+                for fname in ns.filenames
+            ]
+        except LookupError as e:
+            print(e.args[0], file=sys.stderr)
+            exit(1)
 
     if ns.baseline:
+        if ns.adjust_lightness is not None:
+            adjust_theme_lightness(BASELINE_THEME, ns.adjust_lightness)
         themes.append(BASELINE_THEME)
-
-    if ns.adjust_lightness is not None:
-        for theme in themes:
-            theme.fg = adjust_lightness(theme.fg, ns.adjust_lightness)
-            theme.bg = adjust_lightness(theme.bg, ns.adjust_lightness)
-            for i in range(min(16, len(theme.palette))):
-                theme[i] = adjust_lightness(theme[i], ns.adjust_lightness)
-
-    for theme in themes:
-        if theme != BASELINE_THEME:
-            generate_palette(theme)
     
     if ns.generate:
-        if ns.output is not None:
-            parent = ns.output or "."
-            os.makedirs(parent, exist_ok=True)
-            for theme in themes:
-                fname = os.path.join(ns.output or ".", theme.name + "." + ns.generate + ".txt")
-                with open(fname, "w+") as f:
-                    f.write(GENERATE_LOOKUP[ns.generate](theme))
-                    print("generated", fname)
-        else:
+        stdout_formats = [
+            fmt for fmt, path in ns.generate
+            if path is None and ns.output is None and ns.output_template is None
+        ]
+        if stdout_formats:
             if len(themes) == 0:
                 print("No theme selected", file=sys.stderr)
                 exit(1)
-            if len(themes) > 1:
+            if len(themes) > 1 or len(stdout_formats) > 1:
                 print("Can only apply a generate theme unless --output is specified", file=sys.stderr)
                 exit(1)
-            print(GENERATE_LOOKUP[ns.generate](themes[0]))
+        results = []
+        for theme in themes:
+            results += write_theme_outputs(
+                theme,
+                ns.generate,
+                ns.output,
+                ns.output_template,
+                status=sys.stderr if stdout_formats or ns.manifest == "-" else sys.stdout,
+                rendered=rendered.get(id(theme)),
+            )
+        if ns.manifest:
+            write_manifest(ns.manifest, results)
+        if ns.watch:
+            def regenerate(fname):
+                theme = load_theme(
+                    fname,
+                    ns.adjust_lightness,
+                    cache,
+                    search=ns.contrast_search,
+                    precision=ns.contrast_precision,
+                )
+                write_theme_outputs(theme, ns.generate, ns.output, ns.output_template)
+            try:
+                watch_themes(ns.filenames, regenerate, noctalia=ns.noctalia)
+            except KeyboardInterrupt:
+                pass
     elif ns.apply:
         if len(themes) == 0:
             print("No theme selected", file=sys.stderr)
@@ -792,7 +2320,12 @@ def main():
             if len(themes) > 1:
                 print("Can only apply a single theme", file=sys.stderr)
                 exit(1)
-            apply_theme(themes[0])
+            apply_theme(
+                themes[0],
+                diff=ns.diff,
+                timeout=ns.query_timeout,
+                transition=ns.transition,
+            )
     else:
         if themes:
             for i, theme in enumerate(themes):
@@ -806,6 +2339,8 @@ def main():
                     print()
         else:
             preview_theme("Active Theme", list(range(256)))
+    if failed:
+        exit(1)
 
 if __name__ == "__main__":
     main()
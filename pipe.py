@@ -2,12 +2,16 @@
 
 import sys
 import os
+import json
 import random
 import time
 import termios
 import tty
 import select
 import signal
+import heapq
+from argparse import ArgumentParser
+from collections import deque
 
 PIPE_SET = "████▀▀███▀█▀▀██▀"
 FRAME_RATE = 75
@@ -17,6 +21,11 @@ BASE_FADE_DURATION = 1000
 HUE_SPEED = 0.5
 MIN_STRAIGHT_LENGTH = 2
 MAX_STRAIGHT_LENGTH = 10
+FADE_LEVELS = 256
+HUE_LEVELS = 3600
+HUE_STEP = round(HUE_SPEED * HUE_LEVELS / 360)
+MAX_CATCH_UP_STEPS = 4
+HUD_COLOR = 255
 
 resize_flag = False
 
@@ -29,10 +38,153 @@ class Pipe:
         self.x = w // 2
         self.y = h // 2
         self.dir = 0
-        self.hue = random.random() * 360
+        # In 1/HUE_LEVELS turns, so it always lands on a hue_table entry.
+        self.hue = int(random.random() * HUE_LEVELS)
         self.straight_length = random.randint(
             MIN_STRAIGHT_LENGTH, MAX_STRAIGHT_LENGTH)
 
+class FrameBuffer:
+    # Cells are (char, fg, bg) or None for blank. Drawing goes to the back
+    # buffer; flush() compares the touched cells against the front buffer
+    # (what the terminal shows) and writes only the differences in one
+    # os.write, skipping cursor moves and SGR codes the terminal already
+    # has.
+    def __init__(self, w, h):
+        self.resize(w, h)
+
+    def resize(self, w, h):
+        self.w = w
+        self.h = h
+        self.front = [None] * (w * h)
+        self.back = [None] * (w * h)
+        self.dirty = set()
+        # Cursor position and (bold, fg, bg), None while unknown.
+        self.cursor = None
+        self.sgr = None
+        self.pending = ["\033[0m\033[2J"]
+
+    def set(self, x, y, cell):
+        i = y * self.w + x
+        self.back[i] = cell
+        self.dirty.add(i)
+
+    def _move(self, out, i):
+        if self.cursor == i:
+            return
+        y, x = divmod(i, self.w)
+        if self.cursor is not None and self.cursor // self.w == y and self.cursor < i:
+            out.append(f"\033[{i - self.cursor}C")
+        else:
+            out.append(f"\033[{y + 1};{x + 1}H")
+
+    def _style(self, out, cell):
+        codes = []
+        if self.sgr is None:
+            codes.append("0")
+            bold, fg, bg = False, None, None
+        else:
+            bold, fg, bg = self.sgr
+        if cell is None:
+            if bg is not None:
+                codes.append("49")
+            bg = None
+        else:
+            _, cell_fg, cell_bg = cell
+            if not bold:
+                codes.append("1")
+                bold = True
+            if cell_fg != fg:
+                codes.append(f"38;5;{cell_fg}")
+                fg = cell_fg
+            if cell_bg != bg:
+                codes.append("49" if cell_bg is None else f"48;5;{cell_bg}")
+                bg = cell_bg
+        if codes:
+            out.append(f"\033[{';'.join(codes)}m")
+        self.sgr = (bold, fg, bg)
+
+    def flush(self, fd):
+        out = self.pending
+        self.pending = []
+        front, back = self.front, self.back
+        for i in sorted(self.dirty):
+            cell = back[i]
+            if cell == front[i]:
+                continue
+            front[i] = cell
+            self._move(out, i)
+            self._style(out, cell)
+            out.append(" " if cell is None else cell[0])
+            # Writing the last column leaves the cursor in a pending-wrap
+            # state, so its position is treated as unknown.
+            self.cursor = i + 1 if (i + 1) % self.w else None
+        self.dirty.clear()
+        data = "".join(out).encode()
+        size = len(data)
+        while data:
+            data = data[os.write(fd, data):]
+        return size
+
+
+class FrameScheduler:
+    # Fixed timestep against time.monotonic(). tick() says how many
+    # simulation steps are due: one on time, more to catch up after a
+    # slow frame, at most MAX_CATCH_UP_STEPS with the rest skipped.
+    # Every due step that is not drawn counts as dropped.
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.deadline = time.monotonic()
+        self.dropped = 0
+
+    def tick(self):
+        late = time.monotonic() - self.deadline
+        due = 1 + max(0, int(late / self.interval))
+        self.deadline += due * self.interval
+        self.dropped += due - 1
+        return min(due, MAX_CATCH_UP_STEPS)
+
+    def wait(self):
+        delay = self.deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class FrameStats:
+    # Per-frame timings for the --hud overlay and the --log JSON lines.
+    def __init__(self, log=None):
+        self.log = log
+        self.window_start = time.monotonic()
+        self.window_frames = 0
+        self.fps = 0.0
+        self.text = ""
+
+    def record(self, frame, steps, dropped, sim_time, render_time, written):
+        now = time.monotonic()
+        self.window_frames += 1
+        if now - self.window_start >= 1.0:
+            self.fps = self.window_frames / (now - self.window_start)
+            self.window_start = now
+            self.window_frames = 0
+        self.text = (
+            f" {self.fps:5.1f} fps  sim {sim_time * 1000:6.2f} ms"
+            f"  render {render_time * 1000:6.2f} ms  {written:7d} B"
+            f"  dropped {dropped} "
+        )
+        if self.log is not None:
+            self.log.write(json.dumps({
+                "frame": frame,
+                "steps": steps,
+                "sim_ms": round(sim_time * 1000, 3),
+                "render_ms": round(render_time * 1000, 3),
+                "bytes": written,
+                "dropped": dropped,
+            }) + "\n")
+
+    def draw(self, screen):
+        for x, char in enumerate(self.text[:screen.w]):
+            screen.set(x, 0, (char, HUD_COLOR, 0))
+
+
 def hsv_to_rgb(h, s, v):
     h = h % 360
     c = v * s
@@ -80,35 +232,104 @@ def fade_color(color_idx, fade_amount):
     return rgb_to_color_index(r, g, b)
 
 
-def find_empty_square(grid, w, h, pipe_x, pipe_y, grid_size=4):
-    closest = None
-    closest_dist = float('inf')
+class Occupancy:
+    # Occupied-cell counts for the square blocks find_empty_square can
+    # pick: size x size cells, one every size rows and every 2 * size
+    # columns.
+    def __init__(self, w, h, size=4):
+        self.size = size
+        self.rows = h // size
+        self.cols = (w + size) // (2 * size)
+        self.counts = [0] * (self.rows * self.cols)
+        self.empty = len(self.counts)
+
+    def _block(self, x, y):
+        bx, dx = divmod(x, 2 * self.size)
+        by = y // self.size
+        if dx >= self.size or bx >= self.cols or by >= self.rows:
+            return None
+        return by * self.cols + bx
+
+    def add(self, x, y):
+        block = self._block(x, y)
+        if block is not None:
+            if self.counts[block] == 0:
+                self.empty -= 1
+            self.counts[block] += 1
+
+    def remove(self, x, y):
+        block = self._block(x, y)
+        if block is not None:
+            self.counts[block] -= 1
+            if self.counts[block] == 0:
+                self.empty += 1
+
+
+def outward(count, pitch, offset, pos):
+    # Yields (distance, i) for the points i * pitch + offset, i < count,
+    # nearest to pos first and the lower i first on ties.
+    lo = max(-1, min(count - 1, (pos - offset) // pitch))
+    hi = lo + 1
+    while lo >= 0 or hi < count:
+        d_lo = pos - (lo * pitch + offset) if lo >= 0 else float('inf')
+        d_hi = hi * pitch + offset - pos if hi < count else float('inf')
+        if d_lo <= d_hi:
+            yield d_lo, lo
+            lo -= 1
+        else:
+            yield d_hi, hi
+            hi += 1
+
+
+def build_fade_table(fade_duration):
+    # fade_table[color - 16][level] is the cube color faded by
+    # level / (len(row) - 1). With short fades every frame gets its own
+    # level, otherwise the fade is split into FADE_LEVELS steps.
+    steps = min(fade_duration, FADE_LEVELS)
+    return [
+        bytes(fade_color(color, level / steps) for level in range(steps + 1))
+        for color in range(16, 232)
+    ]
+
+
+def build_hue_table():
+    return bytes(
+        rgb_to_color_index(*hsv_to_rgb(i * 360 / HUE_LEVELS, 1.0, 1.0))
+        for i in range(HUE_LEVELS)
+    )
+
+
+def find_empty_square(occupancy, pipe_x, pipe_y):
+    # Best-first search over blocks by Manhattan distance from the pipe to
+    # the block center. Every row has the same columns, so a row only
+    # needs to be queued once the nearer row before it has been reached.
+    # Ties go to the topmost, then leftmost block.
+    if occupancy.empty == 0:
+        return None
     
-    for grid_y in range(0, h, grid_size):
-        for grid_x in range(0, w, grid_size * 2):
-            if grid_y + grid_size > h or grid_x + grid_size > w:
-                continue
-            
-            empty = True
-            for dy in range(grid_size):
-                for dx in range(grid_size):
-                    if grid[grid_y + dy][grid_x + dx] is not None:
-                        empty = False
-                        break
-                if not empty:
-                    break
-            
-            if empty:
-                center_x = grid_x + grid_size // 2
-                center_y = grid_y + grid_size // 2
-                
-                dist = abs(center_x - pipe_x) + abs(center_y - pipe_y)
-                
-                if dist < closest_dist:
-                    closest_dist = dist
-                    closest = (center_x, center_y)
+    size = occupancy.size
+    rows = outward(occupancy.rows, size, size // 2, pipe_y)
+    heap = []
+    
+    def push_row():
+        for dy, by in rows:
+            columns = outward(occupancy.cols, size * 2, size // 2, pipe_x)
+            dx, bx = next(columns)
+            heapq.heappush(heap, (dy + dx, by, bx, True, dy, columns))
+            return
     
-    return closest
+    push_row()
+    while heap:
+        _, by, bx, first, dy, columns = heapq.heappop(heap)
+        if occupancy.counts[by * occupancy.cols + bx] == 0:
+            return (bx * size * 2 + size // 2, by * size + size // 2)
+        if first:
+            push_row()
+        for dx, bx in columns:
+            heapq.heappush(heap, (dy + dx, by, bx, False, dy, columns))
+            break
+    
+    return None
 
 
 def get_turn_direction(pipe, target_x, target_y):
@@ -128,6 +349,26 @@ def get_turn_direction(pipe, target_x, target_y):
             return random.choice([(pipe.dir + 3) % 4, (pipe.dir + 1) % 4])
 
 
+def fade_level(age, fade_duration, steps):
+    if age < FADE_START_FRAMES:
+        return 0
+    return min(steps, (age - FADE_START_FRAMES) * steps // fade_duration)
+
+
+def fade_cell(cell, frame, fade_duration, fade_table):
+    char, fg_color, bg_color, fg_frame_born, bg_frame_born = cell
+    steps = len(fade_table[0]) - 1
+    
+    fg_level = fade_level(frame - fg_frame_born, fade_duration, steps)
+    faded_fg = fade_table[fg_color - 16][fg_level]
+    
+    faded_bg = None
+    if bg_color is not None:
+        bg_level = fade_level(frame - bg_frame_born, fade_duration, steps) if bg_frame_born is not None else 0
+        faded_bg = fade_table[bg_color - 16][bg_level]
+    return (char, faded_fg, faded_bg)
+
+
 def calculate_fade_duration(w, h):
     screen_area = w * h
     base_area = 80 * 24
@@ -143,10 +384,22 @@ def get_terminal_size():
 def main():
     global resize_flag
     
+    parser = ArgumentParser()
+    parser.add_argument("--hud", action="store_true",
+        help="show frame rate, frame times, bytes written and dropped frames")
+    parser.add_argument("--log", type=str, metavar="PATH",
+        help="append per-frame timings to PATH as JSON lines")
+    ns = parser.parse_args()
+    
+    log = open(ns.log, "a", buffering=1) if ns.log else None
+    stats = FrameStats(log) if ns.hud or log else None
+    
     signal.signal(signal.SIGWINCH, handle_resize)
     
     w, h = get_terminal_size()
     fade_duration = calculate_fade_duration(w, h)
+    fade_table = build_fade_table(fade_duration)
+    hue_table = build_hue_table()
     
     grid = [[None for _ in range(w)] for _ in range(h)]
     
@@ -154,22 +407,31 @@ def main():
     
     print("\033[?1049h", end="")
     print("\033[?25l", end="")
-    print("\033[2J", end="")
     sys.stdout.flush()
     
+    occupancy = Occupancy(w, h)
+    screen = FrameBuffer(w, h)
     pipe = Pipe(w, h)
     frame = 0
+    # (birth frame, x, y) for every fg or bg still shown, in birth order.
+    # Entries for overwritten cells are skipped when they come up.
+    active = deque()
+    scheduler = FrameScheduler(FRAME_RATE)
     
     while True:
             if resize_flag:
                 resize_flag = False
                 w, h = get_terminal_size()
-                fade_duration = calculate_fade_duration(w, h)
+                new_fade_duration = calculate_fade_duration(w, h)
+                if new_fade_duration != fade_duration:
+                    fade_duration = new_fade_duration
+                    fade_table = build_fade_table(fade_duration)
                 grid = [[None for _ in range(w)] for _ in range(h)]
+                active.clear()
+                occupancy = Occupancy(w, h)
+                screen.resize(w, h)
                 pipe = Pipe(w, h)
                 frame = 0
-                print("\033[2J", end="")
-                sys.stdout.flush()
                 continue
             
             if select.select([sys.stdin], [], [], 0)[0]:
@@ -177,101 +439,111 @@ def main():
                 if key in ['q', '\x1b']:
                     break
             
-            pipe.hue = (pipe.hue + HUE_SPEED) % 360
-            
-            if pipe.dir % 2 == 0 and frame % 2 == 1:
-                pass
-            else:
-                next_dir = pipe.dir
+            steps = scheduler.tick()
+            sim_start = time.perf_counter()
+            for _ in range(steps):
+                pipe.hue = (pipe.hue + HUE_STEP) % HUE_LEVELS
+                
+                if pipe.dir % 2 == 0 and frame % 2 == 1:
+                    pass
+                else:
+                    next_dir = pipe.dir
                 
-                pipe.straight_length -= 1
-                if pipe.straight_length <= 0:
-                    target = find_empty_square(grid, w, h, pipe.x, pipe.y)
+                    pipe.straight_length -= 1
+                    if pipe.straight_length <= 0:
+                        target = find_empty_square(occupancy, pipe.x, pipe.y)
                     
-                    if target is not None:
-                        target_x, target_y = target
-                        next_dir = get_turn_direction(pipe, target_x, target_y)
-                    else:
-                        next_dir = random.choice([(pipe.dir + 3) % 4, (pipe.dir + 1) % 4])
+                        if target is not None:
+                            target_x, target_y = target
+                            next_dir = get_turn_direction(pipe, target_x, target_y)
+                        else:
+                            next_dir = random.choice([(pipe.dir + 3) % 4, (pipe.dir + 1) % 4])
                     
-                    pipe.straight_length = random.randint(
-                        MIN_STRAIGHT_LENGTH, MAX_STRAIGHT_LENGTH)
+                        pipe.straight_length = random.randint(
+                            MIN_STRAIGHT_LENGTH, MAX_STRAIGHT_LENGTH)
                 
-                r, g, b = hsv_to_rgb(pipe.hue, 1.0, 1.0)
-                color_idx = rgb_to_color_index(r, g, b)
+                    color_idx = hue_table[pipe.hue]
                 
-                char = PIPE_SET[pipe.dir * 4 + next_dir]
+                    char = PIPE_SET[pipe.dir * 4 + next_dir]
                 
-                existing = grid[pipe.y][pipe.x]
+                    existing = grid[pipe.y][pipe.x]
                 
-                bg_color = None
-                bg_frame = None
-                fg_frame = frame
+                    bg_color = None
+                    bg_frame = None
+                    fg_frame = frame
                 
-                if existing is not None:
-                    existing_char, existing_fg, existing_bg, existing_fg_frame, existing_bg_frame = existing
+                    if existing is not None:
+                        existing_char, existing_fg, existing_bg, existing_fg_frame, existing_bg_frame = existing
                     
-                    if existing_char == '█' and char == '▀':
-                        bg_color = existing_fg
-                        bg_frame = existing_fg_frame
-                    elif existing_char == '▀' and char == '▀':
-                        bg_color = existing_bg
-                        bg_frame = existing_bg_frame
+                        if existing_char == '█' and char == '▀':
+                            bg_color = existing_fg
+                            bg_frame = existing_fg_frame
+                        elif existing_char == '▀' and char == '▀':
+                            bg_color = existing_bg
+                            bg_frame = existing_bg_frame
                 
-                esc = f"\033[{pipe.y + 1};{pipe.x + 1}H\033[1m\033[38;5;{color_idx}m"
-                if bg_color is not None:
-                    esc += f"\033[48;5;{bg_color}m"
-                esc += f"{char}\033[0m"
+                    screen.set(pipe.x, pipe.y, (char, color_idx, bg_color))
                 
-                print(esc, end="")
+                    if existing is None:
+                        occupancy.add(pipe.x, pipe.y)
+                    grid[pipe.y][pipe.x] = (char, color_idx, bg_color, fg_frame, bg_frame)
+                    active.append((frame, pipe.x, pipe.y))
                 
-                grid[pipe.y][pipe.x] = (char, color_idx, bg_color, fg_frame, bg_frame)
+                    pipe.dir = next_dir
                 
-                pipe.dir = next_dir
+                    if pipe.dir % 2 == 1:
+                        pipe.x += -pipe.dir + 2
+                    else:
+                        pipe.y += pipe.dir - 1
                 
-                if pipe.dir % 2 == 1:
-                    pipe.x += -pipe.dir + 2
-                else:
-                    pipe.y += pipe.dir - 1
+                    pipe.x = pipe.x % w
+                    pipe.y = pipe.y % h
                 
-                pipe.x = pipe.x % w
-                pipe.y = pipe.y % h
-            
-            for y in range(h):
-                for x in range(w):
+                # Oldest first: cells whose fade has run out are dropped from
+                # the front, then cells old enough to fade are redrawn.
+                fade_end = FADE_START_FRAMES + fade_duration
+                while active and frame - active[0][0] >= fade_end:
+                    born, x, y = active.popleft()
                     cell = grid[y][x]
-                    if cell is None:
+                    if cell is None or born not in (cell[3], cell[4]):
                         continue
-                    
-                    char, fg_color, bg_color, fg_frame_born, bg_frame_born = cell
-                    
-                    fg_age = frame - fg_frame_born
-                    bg_age = frame - bg_frame_born if bg_frame_born is not None else 0
-                    
-                    if fg_age < FADE_START_FRAMES and (bg_color is None or bg_age < FADE_START_FRAMES):
-                        continue
-                    
-                    fg_fade = min(1.0, (fg_age - FADE_START_FRAMES) / fade_duration) if fg_age >= FADE_START_FRAMES else 0.0
-                    bg_fade = min(1.0, (bg_age - FADE_START_FRAMES) / fade_duration) if bg_color and bg_age >= FADE_START_FRAMES else 0.0
-                    
-                    if fg_fade >= 1.0 and (bg_color is None or bg_fade >= 1.0):
-                        print(f"\033[{y + 1};{x + 1}H \033[0m", end="")
+                    if born == cell[3]:
+                        screen.set(x, y, None)
+                        occupancy.remove(x, y)
                         grid[y][x] = None
+                    else:
+                        # The bg is fully faded; keep it at its final color so
+                        # the cell no longer depends on this entry.
+                        cell = cell[:2] + (fade_table[cell[2] - 16][-1], cell[3], None)
+                        grid[y][x] = cell
+                        screen.set(x, y, fade_cell(cell, frame, fade_duration, fade_table))
+                
+                for born, x, y in active:
+                    if frame - born < FADE_START_FRAMES:
+                        break
+                    cell = grid[y][x]
+                    if cell is None or born not in (cell[3], cell[4]):
                         continue
-                    
-                    faded_fg = fade_color(fg_color, fg_fade)
-                    esc = f"\033[{y + 1};{x + 1}H\033[1m\033[38;5;{faded_fg}m"
-                    
-                    if bg_color is not None:
-                        faded_bg = fade_color(bg_color, bg_fade)
-                        esc += f"\033[48;5;{faded_bg}m"
-                    
-                    esc += f"{char}\033[0m"
-                    print(esc, end="")
+                    if born == cell[4] and frame - cell[3] >= FADE_START_FRAMES:
+                        continue
+                    screen.set(x, y, fade_cell(cell, frame, fade_duration, fade_table))
+                
+                frame += 1
             
-            sys.stdout.flush()
-            frame += 1
-            time.sleep(1.0 / FRAME_RATE)
+            if stats is not None:
+                stats.draw(screen)
+            render_start = time.perf_counter()
+            written = screen.flush(sys.stdout.fileno())
+            if stats is not None:
+                stats.record(
+                    frame,
+                    steps,
+                    scheduler.dropped,
+                    render_start - sim_start,
+                    time.perf_counter() - render_start,
+                    written,
+                )
+            scheduler.wait()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,22 @@
+import unittest
+
+from main import recolor_sgr
+
+def nearest(r, g, b):
+    return 0
+
+class RecolorSgrTest(unittest.TestCase):
+    def test_rewrites_truecolor(self):
+        self.assertEqual(recolor_sgr(b"1;38;2;1;2;3;4", nearest), b"1;38;5;0;4")
+
+    def test_indexed_color_arguments_are_not_codes(self):
+        self.assertEqual(recolor_sgr(b"38;5;38;2;3;4;9", nearest), b"38;5;38;2;3;4;9")
+
+    def test_unrewritten_units_are_copied_whole(self):
+        self.assertEqual(recolor_sgr(b"38;2;300;0;0;2;3", nearest), b"38;2;300;0;0;2;3")
+        self.assertEqual(recolor_sgr(b"48;2;x;0;0;4", nearest), b"48;2;x;0;0;4")
+        self.assertEqual(recolor_sgr(b"38;5;7;48;2;1;2;3", nearest, remap=bytes(range(256))),
+            b"38;5;7;48;5;0")
+
+if __name__ == "__main__":
+    unittest.main()
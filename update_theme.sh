@@ -11,12 +11,22 @@ OUTPUT_PATH=${1:-"$THEME_DIR/themes/my_material.txt"}
 cd "$THEME_DIR"
 python3 convert_noctalia.py "$NOCTALIA_COLORS" "$OUTPUT_PATH"
 
+MANIFEST=$(mktemp)
+trap 'rm -f "$MANIFEST"' EXIT
+
+# Succeeds if main.py actually rewrote the config for the given format
+config_changed() {
+    python3 -c 'import json, sys; sys.exit(0 if json.load(open(sys.argv[1]))["changed"].get(sys.argv[2]) else 1)' "$MANIFEST" "$1" 2>/dev/null
+}
+
 # Function to reload applications
 reload_applications() {
     echo "Reloading applications..."
     
     # Reload Kitty if running
-    if pgrep -x "kitty" > /dev/null; then
+    if ! config_changed kitty; then
+        echo "  Kitty config unchanged"
+    elif pgrep -x "kitty" > /dev/null; then
         echo "  Reloading Kitty..."
         # Add small delay to ensure config is written before signaling
         sleep 0.1
@@ -27,73 +37,51 @@ reload_applications() {
     fi
     
     # Reload Ghostty if running
-    if pgrep -x "ghostty" > /dev/null; then
+    if config_changed ghostty && pgrep -x "ghostty" > /dev/null; then
         echo "  Ghostty config updated (restart required)"
     fi
     
     # Reload WezTerm if running
-    if pgrep -x "wezterm" > /dev/null; then
+    if config_changed wezterm && pgrep -x "wezterm" > /dev/null; then
         echo "  WezTerm config updated (restart required)"
     fi
     
     # Reload Alacritty if running
-    if pgrep -x "alacritty" > /dev/null; then
+    if config_changed alacritty && pgrep -x "alacritty" > /dev/null; then
         echo "  Alacritty config updated (restart required)"
     fi
     
     # Reload Foot if running
-    if pgrep -x "foot" > /dev/null; then
+    if config_changed foot && pgrep -x "foot" > /dev/null; then
         echo "  Reloading Foot..."
         pkill -USR1 foot 2>/dev/null || echo "    Could not reload Foot (try restarting manually)"
     fi
     
     # Reload X resources for st and other X11 apps
-    if [ -n "$DISPLAY" ]; then
+    if [ -n "$DISPLAY" ] && config_changed xresources; then
         echo "  Reloading X resources..."
         xrdb -merge ~/.Xresources 2>/dev/null || echo "    Could not reload X resources"
     fi
 }
 
-# Update Kitty config
-if python3 main.py --generate kitty "$OUTPUT_PATH" > ~/.config/kitty/my_material.conf; then
-    KITTY_SUCCESS="Kitty config updated"
-else
-    KITTY_SUCCESS="Failed to update Kitty config"
-fi
+# Generate every terminal config from a single palette computation
+TARGETS="kitty=$HOME/.config/kitty/my_material.conf"
 
 # Update other terminal configs (optional, create them if they don't exist)
 UPDATE_OTHER=${2:-"true"}
 if [ "$UPDATE_OTHER" = "true" ]; then
     echo "Updating other terminal configs..."
-    
-    # Ghostty
-    mkdir -p ~/.config/ghostty
-    if python3 main.py --generate ghostty "$OUTPUT_PATH" > ~/.config/ghostty/my_material.conf; then
-        echo "  Ghostty config updated"
-    fi
-    
-    # WezTerm
-    mkdir -p ~/.config/wezterm
-    if python3 main.py --generate wezterm "$OUTPUT_PATH" > ~/.config/wezterm/my_material.lua; then
-        echo "  WezTerm config updated"
-    fi
-    
-    # Alacritty
-    mkdir -p ~/.config/alacritty
-    if python3 main.py --generate alacritty "$OUTPUT_PATH" > ~/.config/alacritty/my_material.yml; then
-        echo "  Alacritty config updated"
-    fi
-    
-    # Foot
-    mkdir -p ~/.config/foot
-    if python3 main.py --generate foot "$OUTPUT_PATH" > ~/.config/foot/my_material.ini; then
-        echo "  Foot config updated"
-    fi
-    
-    # X resources (for st and other X apps)
-    if python3 main.py --generate xresources "$OUTPUT_PATH" > ~/.Xresources.my_material; then
-        echo "  X resources updated"
-    fi
+    TARGETS="$TARGETS,ghostty=$HOME/.config/ghostty/my_material.conf"
+    TARGETS="$TARGETS,wezterm=$HOME/.config/wezterm/my_material.lua"
+    TARGETS="$TARGETS,alacritty=$HOME/.config/alacritty/my_material.yml"
+    TARGETS="$TARGETS,foot=$HOME/.config/foot/my_material.ini"
+    TARGETS="$TARGETS,xresources=$HOME/.Xresources.my_material"
+fi
+
+if python3 main.py --generate "$TARGETS" --manifest "$MANIFEST" "$OUTPUT_PATH"; then
+    KITTY_SUCCESS="Kitty config updated"
+else
+    KITTY_SUCCESS="Failed to update Kitty config"
 fi
 
 # Reload applications